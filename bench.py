@@ -0,0 +1,481 @@
+"""
+ハコツミツミのベンチマーク
+使い方:
+    python bench.py level [--chunks 200] [--keep 1000] [--seed 0]
+    python bench.py layout [--chunks 1000] [--seed 0]
+    python bench.py frames [--frames 3000] [--seed 0] [--no-draw] [--no-holes]
+                       [--eviction oldest|farthest] [--json out.json] [--input in.hktm] [--save-input out.hktm]
+    python bench.py projectiles [--count 500] [--frames 300] [--seed 0]
+    python bench.py batch [--seeds 100] [--first-seed 0] [--policy scripted walk] [--frames 3600]
+                      [--param min_obstacle_count=20 ...] [--workers N] [--out results.json|results.csv]
+    python bench.py hash-check [--seeds 5] [--first-seed 0] [--policy scripted] [--frames 3000] [--max-boxes N]
+"""
+import os
+import csv
+import sys
+import json
+import time
+import random
+import argparse
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+
+# ウィンドウを開かずに実行する
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import pygame as pg
+import main as game
+from levelgen import LevelGenerator
+
+
+def bench_level(chunks: int, keep: int, seed: int):
+    """
+    右方向にチャンクを生成し続け, 1チャンクあたりの生成時間を計測する
+    chunks: 生成するチャンク数
+    keep: Level.keep_chunk_distance(大きくすると退避せずにブロックが増え続ける)
+    seed: 乱数のシード
+    """
+    random.seed(seed)
+    level = game.Level()
+    level.keep_chunk_distance = keep
+    view = pg.Rect(0, 0, 1, 1)
+    times = []
+    for i in range(chunks):
+        # カメラを右端のチャンクに合わせ, 次のチャンクを生成させる
+        view.center = (i * game.WIDTH + game.WIDTH // 2, game.VIEW_POS[1])
+        game.camera.follow(view)
+        start = time.perf_counter()
+        level.update()
+        times.append(time.perf_counter() - start)
+
+    step = max(1, chunks // 10)
+    print(f"{'chunks':>12} {'mean[ms]':>10} {'max[ms]':>10}")
+    for i in range(0, chunks, step):
+        t = times[i:i + step]
+        print(f"{i:>5}-{i + len(t) - 1:<6} {sum(t) / len(t) * 1000:>10.3f} {max(t) * 1000:>10.3f}")
+    print(f"blocks: {len(level.blocks)}, enemies: {len(level.enemies)}")
+
+
+def bench_layout(chunks: int, seed: int):
+    """
+    スプライトを作らずにチャンクの配置だけを生成し, 1チャンクあたりの時間を計測する
+    2周目は同じ配置をキャッシュから取り出す時間を計測する
+    chunks: 左右それぞれに生成するチャンク数
+    seed: 配置の乱数のシード
+    """
+    generator = LevelGenerator(seed, game.WIDTH, game.HEIGHT, cache_size=2 * chunks)
+    keys = [(i, 1) for i in range(1, chunks + 1)] + [(-i, -1) for i in range(1, chunks + 1)]
+    print(f"{'':>8} {'mean[us]':>10} {'max[us]':>10}")
+    for name in ("generate", "cached"):
+        times = []
+        for index, direction in keys:
+            start = time.perf_counter()
+            generator.chunk(index, direction)
+            times.append(time.perf_counter() - start)
+        print(f"{name:>8} {sum(times) / len(times) * 1e6:>10.1f} {max(times) * 1e6:>10.1f}")
+    print(f"cache hits: {generator.hits}, misses: {generator.misses}")
+
+
+class ScriptedInput:
+    """
+    キーボードとマウスの代わりに決まった操作を返す入力
+    右に歩き続けながら, 一定間隔でジャンプ・ハコ投げ・ボム投げ・ハイパー化を行う
+    """
+    def __init__(self, seed: int):
+        """
+        ScriptedInputクラスの初期化
+        seed: 狙う位置を決める乱数のシード(ゲーム本体の乱数とは独立)
+        """
+        self.rng = random.Random(seed)
+        self.frame = 0
+
+    def snapshot(self) -> game.InputSnapshot:
+        """
+        次のフレームの入力を返す
+        返り値: 入力の状態
+        """
+        frame = self.frame
+        self.frame += 1
+        keys = {pg.K_d}
+        if frame % 40 < 5:
+            keys.add(pg.K_SPACE)
+        if frame % 300 == 150:
+            # 投げる位置の予測線を表示する
+            keys.add(pg.K_LCTRL)
+        mouse = (frame % 15 == 0, False, frame % 90 == 45)
+        pos = (game.VIEW_POS[0] + self.rng.randint(100, 400), game.VIEW_POS[1] + self.rng.randint(-300, 100))
+        pressed = frozenset({pg.K_LSHIFT}) if frame % 600 == 599 else frozenset()
+        return game.InputSnapshot(frozenset(keys), mouse, pos, pressed)
+
+
+class WalkInput:
+    """
+    右に歩き続け, 一定間隔でジャンプするだけの入力(ハコもボムも投げない)
+    """
+    def __init__(self, seed: int):
+        """
+        WalkInputクラスの初期化
+        seed: ジャンプの間隔を決める乱数のシード
+        """
+        self.rng = random.Random(seed)
+        self.frame = 0
+        self.next_jump = 0
+
+    def snapshot(self) -> game.InputSnapshot:
+        """
+        次のフレームの入力を返す
+        返り値: 入力の状態
+        """
+        keys = {pg.K_d}
+        if self.frame >= self.next_jump:
+            keys.add(pg.K_SPACE)
+            if self.frame - self.next_jump >= 4:
+                self.next_jump = self.frame + self.rng.randint(20, 80)
+        self.frame += 1
+        # マウスの位置は画面座標. 投げないのでplayerの位置にしておく
+        return game.InputSnapshot(frozenset(keys), (False, False, False), game.VIEW_POS, frozenset())
+
+
+# バッチ実行で使える入力の方針
+POLICIES = {"scripted": ScriptedInput, "walk": WalkInput}
+
+
+def init_worker():
+    """
+    バッチ実行の各プロセスで1度だけ, ウィンドウを開かずに画面を用意する
+    """
+    pg.display.init()
+    pg.font.init()
+    pg.display.set_mode((game.WIDTH, game.HEIGHT))
+
+
+def run_simulation(task: dict) -> dict:
+    """
+    1つのシードと入力の方針で, ゲームオーバーかframesに達するまで描画せずにゲームを進める
+    init_workerを呼んだプロセスで実行する
+    task: seed(乱数のシード), policy(POLICIESのキー), frames(最大フレーム数), params(LevelGeneratorの属性 -> 値)の辞書
+    返り値: 進んだ距離, スコアの内訳, 生存フレーム数, フレーム時間の統計の辞書
+    """
+    random.seed(task["seed"])
+    g = game.Game(pg.display.get_surface(), level_params=task["params"])
+    bot = POLICIES[task["policy"]](task["seed"])
+    frame_times = []
+    start, cpu_start = time.perf_counter(), time.process_time()
+    while g.tmr < task["frames"] and not g.is_game_over:
+        inputs = bot.snapshot()
+        t = time.perf_counter()
+        g.update(inputs)
+        frame_times.append(time.perf_counter() - t)
+    wall, cpu = time.perf_counter() - start, time.process_time() - cpu_start
+    score = g.score
+    score.modify()
+    return {
+        "seed": task["seed"],
+        "policy": task["policy"],
+        "params": task["params"],
+        "frames": g.tmr,
+        "game_over": g.is_game_over,
+        "distance": abs(g.player.rect.centerx - score.player_init_pos_x),
+        "score": score.score,
+        "kill_enemy": score.kill_enemy,
+        "progress": score.progress,
+        "time": score.time,
+        "frame_ms": {k: percentile(frame_times, p) * 1000 if frame_times else 0.0
+                     for k, p in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99), ("max", 1.0))},
+        "frame_ms_mean": sum(frame_times) / max(1, len(frame_times)) * 1000,
+        "wall_s": wall,
+        "cpu_s": cpu,
+    }
+
+
+def bench_batch(seeds: list[int], policies: list[str], frames: int, params: dict, workers: int = None,
+                out_path: str = None):
+    """
+    シードと入力の方針の組ごとのシミュレーションをプロセスプールで並列に実行し, 結果をまとめる
+    ゲームの状態はモジュール単位で共有されるため, 1プロセスで同時に1つだけ実行する
+    seeds: 乱数のシードのリスト
+    policies: 入力の方針(POLICIESのキー)のリスト
+    frames: 1回の最大フレーム数
+    params: 全ての実行でLevelGeneratorに設定する属性 -> 値の辞書
+    workers: プロセス数(Noneでコア数)
+    out_path: 結果を保存するファイルのパス(.jsonなら全ての結果とまとめ, .csvなら1行に1回の結果)
+    """
+    tasks = [{"seed": seed, "policy": policy, "frames": frames, "params": params}
+             for seed, policy in itertools.product(seeds, policies)]
+    workers = workers or os.cpu_count()
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as executor:
+        runs = list(executor.map(run_simulation, tasks))
+    total = time.perf_counter() - start
+
+    summary = {}
+    for policy in policies:
+        rs = [r for r in runs if r["policy"] == policy]
+        summary[policy] = {
+            "runs": len(rs),
+            "game_over": sum(r["game_over"] for r in rs),
+            **{f"{k}_mean": sum(r[k] for r in rs) / len(rs) for k in ("distance", "frames", "score", "kill_enemy")},
+            **{f"{k}_p50": percentile([r[k] for r in rs], 0.5) for k in ("distance", "frames", "score")},
+            "frame_ms_mean": sum(r["frame_ms_mean"] for r in rs) / len(rs),
+            "frame_ms_p99_max": max(r["frame_ms"]["p99"] for r in rs),
+        }
+    # 1プロセスで順に実行した場合の時間(各実行のCPU時間の和)との比
+    speedup = sum(r["cpu_s"] for r in runs) / total
+    print(f"runs: {len(runs)}, workers: {workers}, total: {total:.2f}s, speedup: {speedup:.2f}x")
+    print(f"{'policy':>10} {'game over':>10} {'distance':>10} {'frames':>10} {'score':>10} {'frame[ms]':>10}")
+    for policy, m in summary.items():
+        print(f"{policy:>10} {m['game_over']:>4}/{m['runs']:<5} {m['distance_mean']:>10.0f} {m['frames_mean']:>10.0f} "
+              f"{m['score_mean']:>10.0f} {m['frame_ms_mean']:>10.3f}")
+    if out_path is None:
+        return
+    if out_path.endswith(".csv"):
+        fields = ["seed", "policy", "frames", "game_over", "distance", "score", "kill_enemy", "progress", "time",
+                  "frame_ms_mean", "frame_ms_p50", "frame_ms_p90", "frame_ms_p99", "frame_ms_max", "wall_s", "cpu_s"]
+        with open(out_path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(fields + list(params))
+            for r in runs:
+                row = {**r, **{f"frame_ms_{k}": v for k, v in r["frame_ms"].items()}}
+                writer.writerow([row[k] for k in fields] + list(params.values()))
+    else:
+        with open(out_path, "w") as f:
+            json.dump({"frames": frames, "params": params, "workers": workers, "total_s": total,
+                       "summary": summary, "runs": runs}, f, indent=2)
+
+
+def check_spatial_hash(seeds: list[int], policy: str, frames: int) -> bool:
+    """
+    同じシードと入力で, SpatialHashを使う場合と総当たりの場合のシミュレーションの結果が一致するか確かめる
+    穴のないレベルでframesまで進める
+    seeds: 乱数のシードのリスト
+    policy: 入力の方針(POLICIESのキー)
+    frames: 1回の最大フレーム数
+    返り値: 全てのシードで一致すればTrue
+    """
+    init_worker()
+    use_spatial_hash = game.USE_SPATIAL_HASH
+    mismatches = 0
+    for seed in seeds:
+        summaries = []
+        for use in (True, False):
+            game.USE_SPATIAL_HASH = use
+            random.seed(seed)
+            # 途中でゲームオーバーにならないよう穴を作らない
+            g = game.Game(pg.display.get_surface(), level_params={"max_hole_width": 0})
+            bot = POLICIES[policy](seed)
+            while g.tmr < frames and not g.is_game_over:
+                g.update(bot.snapshot())
+            summaries.append(g.summary())
+        if summaries[0] == summaries[1]:
+            print(f"seed {seed}: 一致 {summaries[0]}")
+        else:
+            mismatches += 1
+            print(f"seed {seed}: 不一致 SpatialHash {summaries[0]} 総当たり {summaries[1]}")
+    game.USE_SPATIAL_HASH = use_spatial_hash
+    return mismatches == 0
+
+
+def parse_param(text: str) -> tuple[str, int]:
+    """
+    --paramの"名前=値"を解析する
+    text: "名前=値"
+    返り値: (LevelGeneratorの属性名, 整数の値)
+    """
+    name, sep, value = text.partition("=")
+    generator = LevelGenerator(0, game.WIDTH, game.HEIGHT)
+    if not sep or not hasattr(generator, name) or not isinstance(getattr(generator, name), int):
+        raise argparse.ArgumentTypeError(f"LevelGeneratorの整数の属性ではありません: {text}")
+    return name, int(value)
+
+
+def bench_projectiles(count: int, frames: int, seed: int):
+    """
+    Box, Bombをcount個ずつ空中に生成し, 衝突判定を除いた1フレームの更新時間を計測する
+    count: 種類ごとの個数
+    frames: 計測するフレーム数
+    seed: 乱数のシード
+    """
+    pg.display.init()
+    pg.display.set_mode((game.WIDTH, game.HEIGHT))
+    kinds = ((game.Box, game.Box.boxes), (game.Bomb, game.Bomb.bombs))
+    # 個数を保つため上限をなくす
+    caps = [cls.pool.cap for cls, _ in kinds]
+    for cls, _ in kinds:
+        cls.pool.cap = None
+    rng = random.Random(seed)
+    times = []
+    for frame in range(frames):
+        # 寿命で消えた分を補充する
+        for cls, group in kinds:
+            for _ in range(count - len(group)):
+                cls.spawn((rng.randint(0, game.WIDTH), rng.randint(-5000, 0)), (rng.uniform(-10, 10), rng.uniform(-20, 0)))
+        start = time.perf_counter()
+        for cls, _ in kinds:
+            cls.update_all()
+        times.append(time.perf_counter() - start)
+    print(f"mean: {sum(times) / frames * 1000:.3f}ms, max: {max(times) * 1000:.3f}ms")
+    for s in game.registry.world.sprites():
+        s.kill()
+    for (cls, _), cap in zip(kinds, caps):
+        cls.pool.cap = cap
+
+
+def percentile(values: list, p: float) -> float:
+    """
+    パーセンタイルを求める
+    values: 値のリスト
+    p: 0.0~1.0
+    返り値: パーセンタイル値
+    """
+    values = sorted(values)
+    return values[int(p * (len(values) - 1))]
+
+
+def bench_frames(frames: int, seed: int, draw: bool, no_holes: bool, json_path: str = None,
+                 input_path: str = None, save_input_path: str = None):
+    """
+    ウィンドウ・音声・実際の入力なしでゲームループを回し, フレーム時間を計測する
+    frames: 実行するフレーム数(フレームレート制限なし)
+    seed: 乱数のシード
+    draw: 描画も計測するかどうか
+    no_holes: 穴を作らない(ゲームオーバーにならない)
+    json_path: 結果を保存するJSONファイルのパス
+    input_path: 決まった操作の代わりに再生する入力の記録(main.py --recordのファイル). 記録のシードを使い, 記録の長さで止める
+    save_input_path: 使った入力とシードを保存するファイル(main.py --replayで再生できる)
+    """
+    replay = None
+    if input_path is not None:
+        log = game.InputLog.load(input_path)
+        seed, frames = log.seed, min(frames, len(log.snapshots))
+        replay = game.InputReplay(log.snapshots)
+    random.seed(seed)
+    pg.display.init()
+    pg.font.init()
+    screen = pg.display.set_mode((game.WIDTH, game.HEIGHT))
+    timer = game.PhaseTimer(enabled=True)
+    bot = ScriptedInput(seed) if replay is None else replay
+    used_inputs = []
+
+    def new_game() -> game.Game:
+        return game.Game(screen, timer, {"max_hole_width": 0} if no_holes else None)
+
+    g = new_game()
+    deaths = 0
+    frame_times = []
+    phase_times = {}
+    peak_counts = {}
+    total_start = time.perf_counter()
+    for frame in range(frames):
+        if g.is_game_over:
+            deaths += 1
+            g = new_game()
+        inputs = bot.snapshot()
+        if save_input_path is not None:
+            used_inputs.append(inputs)
+        start = time.perf_counter()
+        g.begin_frame()
+        g.update(inputs)
+        if draw:
+            g.draw()
+        frame_times.append(time.perf_counter() - start)
+        for name, t in timer.phases.items():
+            phase_times.setdefault(name, []).append(t)
+        for kind, n in game.registry.counts().items():
+            peak_counts[kind] = max(peak_counts.get(kind, 0), n)
+    total = time.perf_counter() - total_start
+
+    result = {
+        "frames": frames,
+        "seed": seed,
+        "deaths": deaths,
+        "total_s": total,
+        "frame_ms": {k: percentile(frame_times, p) * 1000 for k, p in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99), ("max", 1.0))},
+        "phase_ms": {name: {"mean": sum(t) / frames * 1000, "p99": percentile(t, 0.99) * 1000} for name, t in phase_times.items()},
+        "counts": {"live": game.registry.counts(), "peak": peak_counts},
+        "evicted": {kind: cls.pool.evicted for kind, cls in (("box", game.Box), ("bomb", game.Bomb), ("explode", game.Explode))},
+    }
+    print(f"frames: {frames}, deaths: {deaths}, total: {total:.2f}s ({frames / total:.1f} fps)")
+    print("frame[ms]: " + ", ".join(f"{k} {v:.3f}" for k, v in result["frame_ms"].items()))
+    print(f"{'phase':>16} {'mean[ms]':>10} {'p99[ms]':>10}")
+    for name, t in result["phase_ms"].items():
+        print(f"{name:>16} {t['mean']:>10.3f} {t['p99']:>10.3f}")
+    print(f"{'kind':>16} {'live':>10} {'peak':>10} {'evicted':>10}")
+    for kind, n in peak_counts.items():
+        print(f"{kind:>16} {result['counts']['live'].get(kind, 0):>10} {n:>10} {result['evicted'].get(kind, 0):>10}")
+    if json_path is not None:
+        with open(json_path, "w") as f:
+            json.dump(result, f, indent=2)
+    if save_input_path is not None:
+        log = game.InputLog(seed, used_inputs)
+        # 1回のゲームを穴のあるレベル(main.pyと同じ)で進めた場合だけ, 再生で確かめられる結果を残す
+        if deaths == 0 and not no_holes:
+            log.finish(g)
+        log.save(save_input_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("level", help="チャンク生成時間の計測")
+    p.add_argument("--chunks", type=int, default=200)
+    p.add_argument("--keep", type=int, default=1000)
+    p.add_argument("--seed", type=int, default=0)
+    p = sub.add_parser("layout", help="チャンクの配置だけの生成時間の計測")
+    p.add_argument("--chunks", type=int, default=1000)
+    p.add_argument("--seed", type=int, default=0)
+    p = sub.add_parser("frames", help="ヘッドレスでのフレーム時間の計測")
+    p.add_argument("--frames", type=int, default=3000)
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--no-draw", action="store_true", help="描画を行わない")
+    p.add_argument("--no-holes", action="store_true", help="穴を作らない")
+    p.add_argument("--eviction", choices=("oldest", "farthest"), help="上限に達したときに消すもの(省略時はENTITY_EVICTION)")
+    p.add_argument("--json", help="結果を保存するJSONファイル")
+    p.add_argument("--input", help="決まった操作の代わりに再生する入力の記録(main.py --recordのファイル)")
+    p.add_argument("--save-input", help="使った入力を記録するファイル(main.py --replayで再生できる)")
+    p = sub.add_parser("projectiles", help="Box, Bombの更新時間の計測")
+    p.add_argument("--count", type=int, default=500)
+    p.add_argument("--frames", type=int, default=300)
+    p.add_argument("--seed", type=int, default=0)
+    p = sub.add_parser("batch", help="多数のシードでのシミュレーションの並列実行")
+    p.add_argument("--seeds", type=int, default=100, help="実行するシードの数")
+    p.add_argument("--first-seed", type=int, default=0)
+    p.add_argument("--policy", nargs="+", choices=tuple(POLICIES), default=["scripted"], help="入力の方針(複数指定可)")
+    p.add_argument("--frames", type=int, default=3600, help="1回の最大フレーム数")
+    p.add_argument("--param", type=parse_param, action="append", default=[],
+                   help="LevelGeneratorのパラメータ(例: min_obstacle_count=20, 複数指定可)")
+    p.add_argument("--workers", type=int, help="プロセス数(省略時はコア数)")
+    p.add_argument("--out", help="結果を保存するファイル(.jsonまたは.csv)")
+    p = sub.add_parser("hash-check", help="SpatialHashの有無でシミュレーションが一致するかの確認")
+    p.add_argument("--seeds", type=int, default=5, help="確かめるシードの数")
+    p.add_argument("--first-seed", type=int, default=0)
+    p.add_argument("--policy", choices=tuple(POLICIES), default="scripted", help="入力の方針")
+    p.add_argument("--frames", type=int, default=3000, help="1回の最大フレーム数")
+    p.add_argument("--max-boxes", type=int, help="Boxの生存数の上限(小さくすると使い回しが起きる, 省略時はMAX_BOXES)")
+    args = parser.parse_args()
+
+    if args.command == "level":
+        bench_level(args.chunks, args.keep, args.seed)
+    elif args.command == "layout":
+        bench_layout(args.chunks, args.seed)
+    elif args.command == "frames":
+        if args.eviction is not None:
+            for cls in (game.Box, game.Bomb, game.Explode):
+                cls.pool.eviction = args.eviction
+        bench_frames(args.frames, args.seed, not args.no_draw, args.no_holes, args.json, args.input, args.save_input)
+    elif args.command == "projectiles":
+        bench_projectiles(args.count, args.frames, args.seed)
+    elif args.command == "batch":
+        seeds = list(range(args.first_seed, args.first_seed + args.seeds))
+        bench_batch(seeds, args.policy, args.frames, dict(args.param), args.workers, args.out)
+    elif args.command == "hash-check":
+        if args.max_boxes is not None:
+            game.Box.pool.cap = args.max_boxes
+        seeds = list(range(args.first_seed, args.first_seed + args.seeds))
+        if not check_spatial_hash(seeds, args.policy, args.frames):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
+    sys.exit()
@@ -0,0 +1,175 @@
+"""
+ハコツミツミのレベル生成
+pygameを使わずに, (シード, チャンク番号, 方向)からチャンクの配置を決める
+チャンクkはワールド座標のx方向[k * width, (k + 1) * width)を受け持つ
+"""
+import random
+from array import array
+from collections import OrderedDict
+
+
+class ChunkLayout:
+    """
+    1チャンク分の配置のデータ
+    座標はワールド座標の整数で, rectは(x, y, w, h)の4つずつ, 点は(x, y)の2つずつarrayに並べる
+    floorsは生成した順(生成する方向の端の床が最後)に並ぶ
+    """
+    __slots__ = ("index", "direction", "ceil", "floors", "holes", "obstacles", "enemies")
+
+    def __init__(self, index: int, direction: int, ceil: tuple[int, int, int, int],
+                 floors: array, holes: array, obstacles: array, enemies: array):
+        """
+        ChunkLayoutクラスの初期化
+        index: チャンク番号
+        direction: 生成した方向(-1: 左, 1: 右, 0: 最初のチャンク)
+        ceil: 天井のrect
+        floors: 床のrectを並べたarray
+        holes: 穴の(左端のx座標, 幅)を並べたarray
+        obstacles: 障害物のrectを並べたarray
+        enemies: 敵の中心座標を並べたarray
+        """
+        self.index = index
+        self.direction = direction
+        self.ceil = ceil
+        self.floors = floors
+        self.holes = holes
+        self.obstacles = obstacles
+        self.enemies = enemies
+
+    @staticmethod
+    def __group(values: array, n: int) -> list[tuple[int, ...]]:
+        return [tuple(values[i:i + n]) for i in range(0, len(values), n)]
+
+    def floor_rects(self) -> list[tuple[int, int, int, int]]:
+        """
+        返り値: 床のrectのタプルのリスト
+        """
+        return __class__.__group(self.floors, 4)
+
+    def block_rects(self) -> list[tuple[int, int, int, int]]:
+        """
+        返り値: 天井, 床, 障害物の順に並べたブロックのrectのタプルのリスト
+        """
+        return [self.ceil] + self.floor_rects() + __class__.__group(self.obstacles, 4)
+
+    def enemy_centers(self) -> list[tuple[int, int]]:
+        """
+        返り値: 敵の中心座標のタプルのリスト
+        """
+        return __class__.__group(self.enemies, 2)
+
+
+class LevelGenerator:
+    """
+    シードから決まったチャンクの配置を作るクラス
+    同じ(シード, チャンク番号, 方向)には常に同じ配置を返し, 最近使った配置はLRUキャッシュから返す
+    生成のパラメータを変えた後はclear_cacheを呼ぶ
+    """
+    def __init__(self, seed: int, width: int, height: int, cache_size: int = 64):
+        """
+        LevelGeneratorクラスの初期化
+        seed: 乱数のシード
+        width: チャンクの幅(画面幅)
+        height: 画面の高さ
+        cache_size: キャッシュする配置の最大数
+        """
+        self.seed = seed
+        self.width = width
+        self.flcl_height = 100      # 床と天井の高さ
+        self.ceil_y = -height // 2  # 天井の中心y座標
+        self.floor_y = height       # 床の中心y座標
+        # 床
+        self.min_floor_width = 100
+        self.max_floor_width = width // 2
+        # 障害物
+        self.min_obstacle_count = 50
+        self.max_obstacle_count = 100
+        self.min_obstacle_width = 50
+        self.min_obstacle_height = 50
+        self.max_obstacle_width = 100
+        self.max_obstacle_height = 100
+        # 穴
+        self.min_hole_width = 0
+        self.max_hole_width = width // 2
+        # 敵
+        self.min_enemy_count = 10
+        self.max_enemy_count = 20
+        # キャッシュ
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+        self.__cache = OrderedDict()    # (チャンク番号, 方向) -> ChunkLayout
+
+    def chunk(self, index: int, direction: int) -> ChunkLayout:
+        """
+        チャンクの配置を返す. キャッシュになければ生成する
+        index: チャンク番号
+        direction: 生成する方向(-1: 左, 1: 右, 0: 最初のチャンク)
+        返り値: チャンクの配置
+        """
+        key = (index, direction)
+        layout = self.__cache.get(key)
+        if layout is not None:
+            self.hits += 1
+            self.__cache.move_to_end(key)
+            return layout
+        self.misses += 1
+        layout = self.generate(index, direction)
+        self.__cache[key] = layout
+        if len(self.__cache) > self.cache_size:
+            self.__cache.popitem(last=False)
+        return layout
+
+    def clear_cache(self):
+        """
+        キャッシュした配置を全て捨てる
+        """
+        self.__cache.clear()
+
+    def generate(self, index: int, direction: int) -> ChunkLayout:
+        """
+        チャンクの配置を生成する(キャッシュは使わない)
+        床は生成する方向の反対側の端から並べ, 穴を含めてちょうどチャンクの幅を埋める
+        方向が0の場合は穴も障害物も敵もない最初のチャンクを返す
+        index: チャンク番号
+        direction: 生成する方向(-1: 左, 1: 右, 0: 最初のチャンク)
+        返り値: チャンクの配置
+        """
+        width, h = self.width, self.flcl_height
+        left = index * width
+        ceil = (left, self.ceil_y - h // 2, width, h)
+        floor_top = self.floor_y - h // 2
+        floors, holes, obstacles, enemies = array("i"), array("i"), array("i"), array("i")
+        if direction == 0:
+            floors.extend((left, floor_top, width, h))
+            return ChunkLayout(index, direction, ceil, floors, holes, obstacles, enemies)
+
+        # チャンクごとに独立した乱数を使い, 生成する順番によらず同じ配置にする
+        rng = random.Random(f"{self.seed}:{index}:{direction}")
+        edge = left if direction > 0 else left + width
+        total = 0
+        # 生成した床の長さが穴を含めてwidthに達するまで生成
+        while total < width:
+            offset = rng.randint(self.min_hole_width, self.max_hole_width)
+            sizex = rng.randint(self.min_floor_width, self.max_floor_width)
+            if total + offset + sizex >= width:
+                sizex = width - total
+                offset = 0
+            total += offset + sizex
+            if offset > 0:
+                holes.extend((edge if direction > 0 else edge - offset, offset))
+            edge += direction * offset
+            x = edge if direction > 0 else edge - sizex
+            floors.extend((x, floor_top, sizex, h))
+            edge += direction * sizex
+
+        rangex = (left, left + width)
+        rangey = (ceil[1] + h, floor_top)
+        for _ in range(rng.randint(self.min_obstacle_count, self.max_obstacle_count)):
+            cx, cy = rng.randint(*rangex), rng.randint(*rangey)
+            w = rng.randint(self.min_obstacle_width, self.max_obstacle_width)
+            oh = rng.randint(self.min_obstacle_height, self.max_obstacle_height)
+            obstacles.extend((cx - w // 2, cy - oh // 2, w, oh))
+        for _ in range(rng.randint(self.min_enemy_count, self.max_enemy_count)):
+            enemies.extend((rng.randint(*rangex), rng.randint(*rangey)))
+        return ChunkLayout(index, direction, ceil, floors, holes, obstacles, enemies)
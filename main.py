@@ -1,14 +1,756 @@
+import io
+import os
 import sys
+import csv
+import json
+import math
+import time
+import struct
 import random
+import argparse
+import threading
+from collections import OrderedDict, deque
+from typing import NamedTuple
+# pygameのimportにかかる時間も起動時間の内訳に含める
+IMPORT_START = time.perf_counter()
 import pygame as pg
+PYGAME_IMPORT_TIME = time.perf_counter() - IMPORT_START
+from levelgen import LevelGenerator
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 WIDTH = 1600
 HEIGHT = 1000
 # ビューの座標
 VIEW_POS = (WIDTH // 2, HEIGHT - 200)
+# 衝突判定の候補をSpatialHashで絞り込むかどうか(Falseで従来の総当たり判定)
+USE_SPATIAL_HASH = True
+# 変化した領域のみ画面を更新するかどうか
+DIRTY_RECT_RENDERING = False
+# シミュレーションの更新回数[回/秒](描画の頻度によらず一定)
+SIM_FPS = 60
+# 描画の上限[回/秒]
+RENDER_FPS = 120
+# 1回の描画の前に遅れを取り戻すために行う更新の最大回数(超えた分の時間は捨てる)
+MAX_CATCH_UP_STEPS = 5
+# 同時に存在できるBox, Bomb, Explodeの数の上限(Noneで上限なし)
+MAX_BOXES = 300
+MAX_BOMBS = 120
+MAX_EXPLODES = 60
+# 上限に達したときに消すもの("oldest": 古いもの, "farthest": カメラから遠いもの)
+ENTITY_EVICTION = "oldest"
+# 敵がボムを投げる間隔[フレーム]
+ENEMY_THROW_INTERVAL = 60
+# 画像・音声などのファイルを置くディレクトリ(実行時のカレントディレクトリによらない)
+ASSET_ROOT = os.path.dirname(os.path.abspath(__file__))
+# 音声ファイル(ASSET_ROOTからの相対パス)
+GAMEPLAY_BGM = "Audio/GamePlayBGM.mp3"
+GAME_OVER_BGM = "Audio/GameOverBGM.mp3"
+GAME_OVER_SE = "Audio/GameOverSE.mp3"
+# pygameのimportから最初のフレームを描画するまでの目標時間[ms]
+STARTUP_TARGET_MS = 1000
+
+
+class Camera:
+    """
+    スクロールを担うカメラ(ビューポート)に関するクラス
+    オブジェクトはワールド座標のまま保持し, 描画時と画面座標での判定時のみオフセットを適用する
+    """
+    def __init__(self, view_pos: tuple[int, int]):
+        """
+        Cameraクラスの初期化
+        view_pos: 追従対象を表示する画面座標
+        """
+        self.__view_pos = view_pos
+        self.__offset = [0, 0]
+
+    @property
+    def offset(self) -> tuple[int, int]:
+        """
+        オフセットのgetter
+        返り値: ワールド座標から画面座標を得るために引く値のタプル
+        """
+        return tuple(self.__offset)
+
+    def follow(self, rect: pg.Rect):
+        """
+        rectの中心がビュー座標に表示されるようにオフセットを更新する
+        rect: 追従対象のrect(ワールド座標)
+        """
+        self.__offset[0] = rect.centerx - self.__view_pos[0]
+        self.__offset[1] = rect.centery - self.__view_pos[1]
+
+    def apply(self, rect: pg.Rect) -> pg.Rect:
+        """
+        ワールド座標のrectを画面座標に変換する
+        rect: ワールド座標のrect
+        返り値: 画面座標のrect
+        """
+        return rect.move(-self.__offset[0], -self.__offset[1])
+
+    def to_world(self, pos: tuple[int, int]) -> tuple[int, int]:
+        """
+        画面座標をワールド座標に変換する
+        pos: 画面座標
+        返り値: ワールド座標
+        """
+        return (pos[0] + self.__offset[0], pos[1] + self.__offset[1])
+
+    def lerp(self, sprite: pg.sprite.Sprite, alpha: float) -> pg.Rect:
+        """
+        スプライトの前の更新での位置(prev_pos)と現在の位置の間を補間したrectを返す
+        sprite: 対象のスプライト(prev_posがなければ補間しない)
+        alpha: 前の更新からの経過時間の割合(0.0~1.0)
+        返り値: 補間したrect(ワールド座標)
+        """
+        prev = getattr(sprite, "prev_pos", None)
+        if prev is None or alpha >= 1.0:
+            return sprite.rect
+        x, y = sprite.rect.topleft
+        return sprite.rect.move(round((prev[0] - x) * (1 - alpha)), round((prev[1] - y) * (1 - alpha)))
+
+    def draw(self, group: pg.sprite.AbstractGroup, surface: pg.Surface, alpha: float = 1.0):
+        """
+        グループ内のスプライトをオフセットを適用して描画する
+        group: 描画するスプライトのグループ
+        surface: 描画先のSurface
+        alpha: 前の更新からの経過時間の割合(1.0未満なら前の位置との間に補間して描画する)
+        返り値: 描画したrectのリスト
+        """
+        ox, oy = self.__offset
+        if alpha >= 1.0:
+            return surface.blits([(s.image, s.rect.move(-ox, -oy)) for s in group])
+        return surface.blits([(s.image, self.lerp(s, alpha).move(-ox, -oy)) for s in group])
+
+# スクロールのためのカメラ
+camera = Camera(VIEW_POS)
+
+
+class Registry:
+    """
+    ワールド座標で保持するスプライトの登録簿に関するクラス
+    登録は種類ごとのGroupへの所属として持つため, kill()されたスプライトは自動的に登録から外れる
+    """
+    def __init__(self):
+        """
+        Registryクラスの初期化
+        """
+        self.__groups = {}
+        self.world = pg.sprite.Group()  # 登録されている全スプライト
+
+    def register(self, kind: str, sprite: pg.sprite.Sprite):
+        """
+        スプライトを登録する
+        kind: スプライトの種類
+        sprite: 登録するスプライト
+        """
+        if kind not in self.__groups:
+            self.__groups[kind] = pg.sprite.Group()
+        self.__groups[kind].add(sprite)
+        self.world.add(sprite)
+
+    def count(self, kind: str) -> int:
+        """
+        生存しているスプライトの数を返す
+        kind: スプライトの種類
+        返り値: 生存数
+        """
+        group = self.__groups.get(kind)
+        return 0 if group is None else len(group)
+
+    def counts(self) -> dict[str, int]:
+        """
+        種類ごとの生存数を返す
+        返り値: 種類をキー, 生存数を値とする辞書
+        """
+        return {kind: len(group) for kind, group in self.__groups.items()}
+
+    def __len__(self) -> int:
+        return len(self.world)
+
+# 生存しているスプライトの登録簿
+registry = Registry()
+
+
+class ImageCache:
+    """
+    スプライトの画像を(種類, 大きさ, 色)ごとに1枚だけ作り, 共有するクラス
+    同じ画像を複数のスプライトが使うため, 取得した画像を書き換えてはいけない
+    """
+    def __init__(self):
+        """
+        ImageCacheクラスの初期化
+        """
+        self.__surfaces = {}
+
+    def get(self, kind: str, size: tuple[int, int], color: tuple, draw=None) -> pg.Surface:
+        """
+        画像を返す(なければ作る)
+        kind: スプライトの種類
+        size: 大きさ
+        color: 色
+        draw: 塗りつぶしの代わりに画像を描く関数(引数は作ったSurfaceと色)
+        返り値: 共有の画像
+        """
+        key = (kind, size, color)
+        surface = self.__surfaces.get(key)
+        if surface is None:
+            surface = pg.Surface(size)
+            if draw is None:
+                surface.fill(color)
+            else:
+                draw(surface, color)
+            self.__surfaces[key] = surface
+        return surface
+
+    def __len__(self) -> int:
+        return len(self.__surfaces)
+
+# スプライトの画像のキャッシュ
+image_cache = ImageCache()
+
+
+class AssetManager:
+    """
+    音声ファイルをASSET_ROOTからの相対パスで読み込み, キャッシュするクラス
+    preloadで効果音のデコードとBGMのファイルの読み込みを別スレッドで行い, ゲーム中のディスクアクセスとデコードをなくす
+    BGMは長いため全体をデコードせず, ファイルの中身だけをメモリに置いてpg.mixer.musicで再生する
+    """
+    def __init__(self, root: str = ASSET_ROOT):
+        """
+        AssetManagerクラスの初期化
+        root: 相対パスの基準にするディレクトリ
+        """
+        self.root = root
+        self.decode_time = 0.0  # 別スレッドでの読み込みにかかった時間[秒]
+        self.__sounds = {}      # 名前 -> Sound
+        self.__music = {}       # 名前 -> ファイルの中身
+        self.__pending = set()  # 別スレッドで読み込み中の名前
+        self.__thread = None
+        self.__playing = None   # 再生中のBGMのファイルオブジェクト(再生中は参照を保つ)
+
+    def path(self, name: str) -> str:
+        """
+        rootからの相対パスを絶対パスにする
+        name: rootからの相対パス
+        返り値: 絶対パス
+        """
+        return os.path.join(self.root, name)
+
+    def preload(self, sounds: tuple[str, ...] = (), music: tuple[str, ...] = ()):
+        """
+        効果音のデコードとBGMのファイルの読み込みを別スレッドで始める
+        pg.mixerを初期化した後に呼ぶ
+        sounds: デコードしておく効果音の名前
+        music: 読み込んでおくBGMの名前
+        """
+        self.wait()
+        self.__pending = set(sounds) | set(music)
+
+        def load():
+            start = time.perf_counter()
+            for name in sounds:
+                self.__sounds[name] = pg.mixer.Sound(self.path(name))
+            for name in music:
+                with open(self.path(name), "rb") as f:
+                    self.__music[name] = f.read()
+            self.decode_time = time.perf_counter() - start
+
+        self.__thread = threading.Thread(target=load, daemon=True)
+        self.__thread.start()
+
+    def wait(self):
+        """
+        別スレッドでの読み込みが終わるまで待つ
+        """
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+            self.__pending = set()
+
+    def sound(self, name: str) -> pg.mixer.Sound:
+        """
+        効果音を返す(読み込み中なら終わるまで待ち, 読み込んでいなければ読み込む)
+        name: 効果音の名前
+        返り値: 共有のSound
+        """
+        if name in self.__pending:
+            self.wait()
+        sound = self.__sounds.get(name)
+        if sound is None:
+            sound = self.__sounds[name] = pg.mixer.Sound(self.path(name))
+        return sound
+
+    def play_music(self, name: str, loops: int = -1):
+        """
+        BGMを切り替えて再生する. 読み込んでおいたものはメモリから再生する
+        name: BGMの名前
+        loops: 繰り返す回数(-1で無限)
+        """
+        if name in self.__pending:
+            self.wait()
+        data = self.__music.get(name)
+        pg.mixer.music.stop()
+        if data is None:
+            self.__playing = None
+            pg.mixer.music.load(self.path(name))
+        else:
+            self.__playing = io.BytesIO(data)
+            pg.mixer.music.load(self.__playing, os.path.splitext(name)[1][1:])
+        pg.mixer.music.play(loops)
+
+# 音声ファイルの読み込みとキャッシュ
+assets = AssetManager()
+
+
+class SpatialHash:
+    """
+    一様グリッドで衝突判定の候補を絞り込むクラス
+    グループのスプライトをrectが重なるセルに登録し, 同じセルに入っているものだけを判定する
+    USE_SPATIAL_HASHがFalseの場合はpg.spriteの総当たり判定をそのまま使う
+    """
+    def __init__(self, group: pg.sprite.AbstractGroup, cell_size: int = 128):
+        """
+        SpatialHashクラスの初期化
+        group: 判定対象のグループ
+        cell_size: セルの一辺の長さ
+        """
+        self.group = group
+        self.__cell_size = cell_size
+        self.__cells = {}   # セル座標 -> スプライトのリスト
+        self.__entries = {} # スプライト -> [登録順, 登録したセル座標のリスト]
+        self.__count = 0
+
+    def __len__(self) -> int:
+        return len(self.__entries)
+
+    def __cell_keys(self, rect: pg.Rect) -> list[tuple[int, int]]:
+        """
+        rectが重なるセル座標を返す
+        rect: 対象のrect
+        返り値: セル座標のリスト
+        """
+        cs = self.__cell_size
+        return [(x, y)
+                for x in range(rect.left // cs, max(rect.left, rect.right - 1) // cs + 1)
+                for y in range(rect.top // cs, max(rect.top, rect.bottom - 1) // cs + 1)]
+
+    def add(self, sprite: pg.sprite.Sprite):
+        """
+        スプライトを現在のrectの位置で登録する
+        sprite: 登録するスプライト
+        """
+        keys = self.__cell_keys(sprite.rect)
+        for k in keys:
+            self.__cells.setdefault(k, []).append(sprite)
+        self.__entries[sprite] = [self.__count, keys]
+        self.__count += 1
+
+    def remove(self, sprite: pg.sprite.Sprite):
+        """
+        スプライトの登録を解除する
+        sprite: 解除するスプライト
+        """
+        entry = self.__entries.pop(sprite, None)
+        if entry is None:
+            return
+        for k in entry[1]:
+            cell = self.__cells[k]
+            cell.remove(sprite)
+            if not cell:
+                del self.__cells[k]
+
+    def refresh(self, sprites: pg.sprite.AbstractGroup):
+        """
+        動いた可能性のあるスプライトだけ登録し直し, グループから外れたスプライトの登録を解除する
+        登録順はグループの順序に合わせ直す(削除されてから再利用されたスプライトはグループの末尾に移るため)
+        sprites: 動いた可能性のあるスプライト(グループに新しく加わったものを含む)
+        """
+        if not USE_SPATIAL_HASH:
+            return
+        entries = self.__entries
+        for s in sprites:
+            entry = entries.get(s)
+            keys = self.__cell_keys(s.rect)
+            if entry is None or entry[1] != keys:
+                if entry is not None:
+                    self.remove(s)
+                for k in keys:
+                    self.__cells.setdefault(k, []).append(s)
+                entries[s] = [0, keys]
+        # グループ外のものが残っていれば解除する
+        if len(entries) != len(self.group):
+            for s in [s for s in entries if s not in self.group]:
+                self.remove(s)
+        for i, s in enumerate(self.group):
+            entry = entries.get(s)
+            if entry is not None:
+                entry[0] = i
+
+    def query(self, rect: pg.Rect) -> list[pg.sprite.Sprite]:
+        """
+        rectと衝突しているスプライトを返す
+        rect: 判定するrect
+        返り値: 衝突しているスプライトの登録順のリスト
+        """
+        if not USE_SPATIAL_HASH:
+            return [s for s in self.group if rect.colliderect(s.rect)]
+        candidates = set()
+        for k in self.__cell_keys(rect):
+            cell = self.__cells.get(k)
+            if cell:
+                candidates.update(cell)
+        # 総当たり判定と同じ順序にする
+        return self.sort([s for s in candidates if rect.colliderect(s.rect)])
+
+    def sort(self, sprites: list[pg.sprite.Sprite]) -> list[pg.sprite.Sprite]:
+        """
+        登録したスプライトを登録順(総当たり判定でのグループの順序)に並べる
+        sprites: 並べるスプライトのリスト
+        返り値: 並べたリスト
+        """
+        if not USE_SPATIAL_HASH:
+            members = set(sprites)
+            return [s for s in self.group if s in members]
+        entries = self.__entries
+        return sorted(sprites, key=lambda s: entries[s][0])
+
+    def candidates(self, rect: pg.Rect, out: list = None) -> list[pg.sprite.Sprite]:
+        """
+        rectと衝突しているスプライトを順序を気にせずに返す(queryより速い)
+        rect: 判定するrect
+        out: 結果を入れるリスト(渡せば空にしてから詰め, 新しいリストや集合を作らない)
+        返り値: 衝突しているスプライトのリスト(順序は不定, outを渡せばout)
+        """
+        if not USE_SPATIAL_HASH:
+            hits = [s for s in self.group if rect.colliderect(s.rect)]
+            if out is None:
+                return hits
+            out[:] = hits
+            return out
+        cs = self.__cell_size
+        cells = self.__cells
+        x0, x1 = rect.left // cs, max(rect.left, rect.right - 1) // cs
+        y0, y1 = rect.top // cs, max(rect.top, rect.bottom - 1) // cs
+        if out is not None:
+            out.clear()
+            for x in range(x0, x1 + 1):
+                for y in range(y0, y1 + 1):
+                    cell = cells.get((x, y))
+                    if cell:
+                        # 候補は少ないため, 重複はリストを調べて除く
+                        for s in cell:
+                            if rect.colliderect(s.rect) and s not in out:
+                                out.append(s)
+            return out
+        if x0 == x1 and y0 == y1:
+            cell = cells.get((x0, y0))
+            return [s for s in cell if rect.colliderect(s.rect)] if cell else []
+        found = set()
+        for x in range(x0, x1 + 1):
+            for y in range(y0, y1 + 1):
+                cell = cells.get((x, y))
+                if cell:
+                    found.update(cell)
+        return [s for s in found if rect.colliderect(s.rect)]
+
+    def sweep(self, rect: pg.Rect, pos: list, disp: tuple[float, float]) -> tuple[bool, int]:
+        """
+        rectを小数の座標posからdispだけ動かし, 途中で最初に触れるスプライトの手前で止める(swept AABB)
+        止まった軸の移動はそこで打ち切り, 残りの移動はもう一方の軸に沿って続ける(最大2回)
+        最初から重なっているスプライトは無視する(めり込んだものが抜け出せるように)
+        rect: 動かすrect(移動後のposを四捨五入した位置にする)
+        pos: rectの左上の小数の座標のリスト(rectが他の処理で動かされていればrectに合わせ直す)
+        disp: 移動量
+        返り値: x方向で止まったかどうかと, y方向で止まった向き(1: 下向き, -1: 上向き, 0: 止まっていない)のタプル
+        """
+        if abs(pos[0] - rect.x) > 0.5 or abs(pos[1] - rect.y) > 0.5:
+            pos[0], pos[1] = rect.x, rect.y
+        x, y = pos[0], pos[1]
+        dx, dy = disp
+        w, h = rect.size
+        blocked_x, blocked_y = False, 0
+        if dx or dy:
+            # 移動の全体を含むrect(接しているものも含める)の中だけを調べる
+            left, top = int(min(x, x + dx)) - 1, int(min(y, y + dy)) - 1
+            candidates = self.candidates(pg.Rect(left, top, int(abs(dx)) + w + 3, int(abs(dy)) + h + 3))
+            if dx == 0 and candidates:
+                # 縦方向だけの移動(静止・落下中のほとんど)は, 進む先で最も近い面を探すだけでよい
+                rects = [c.rect for c in candidates if x < c.rect.right and c.rect.left < x + w]
+                if dy > 0:
+                    edge = min([r.top for r in rects if r.top >= y + h - 1e-9], default=None)
+                    if edge is not None and edge <= y + h + dy:
+                        y, dy, blocked_y = edge - h, 0, 1
+                else:
+                    edge = max([r.bottom for r in rects if r.bottom <= y + 1e-9], default=None)
+                    if edge is not None and edge >= y + dy:
+                        y, dy, blocked_y = edge, 0, -1
+                candidates = None
+            for _ in range(2):
+                if not candidates or not (dx or dy):
+                    break
+                t_hit, hit, hit_x = 1.0, None, False
+                for s in candidates:
+                    b = s.rect
+                    # 各軸で重なり始める時刻と重なり終わる時刻
+                    if dx > 0:
+                        tx0, tx1 = (b.left - x - w) / dx, (b.right - x) / dx
+                    elif dx < 0:
+                        tx0, tx1 = (b.right - x) / dx, (b.left - x - w) / dx
+                    elif x + w <= b.left or x >= b.right:
+                        continue
+                    else:
+                        tx0, tx1 = -float("inf"), float("inf")
+                    if dy > 0:
+                        ty0, ty1 = (b.top - y - h) / dy, (b.bottom - y) / dy
+                    elif dy < 0:
+                        ty0, ty1 = (b.bottom - y) / dy, (b.top - y - h) / dy
+                    elif y + h <= b.top or y >= b.bottom:
+                        continue
+                    else:
+                        ty0, ty1 = -float("inf"), float("inf")
+                    t0 = max(tx0, ty0)
+                    if t0 < -1e-9 or t0 >= min(tx1, ty1) or t0 > t_hit:
+                        continue
+                    # 同時に触れる場合はy方向(着地)を優先し, 候補の順序によらず同じ結果にする
+                    if t0 == t_hit and hit is not None and (tx0 > ty0 or not hit_x):
+                        continue
+                    t_hit, hit, hit_x = t0, b, tx0 > ty0
+                if hit is None:
+                    break
+                t = max(t_hit, 0.0)
+                # 触れた面にぴったり合わせ, その軸の移動をやめる
+                if hit_x:
+                    x = hit.left - w if dx > 0 else hit.right
+                    y += dy * t
+                    dx, dy = 0, dy * (1 - t)
+                    blocked_x = True
+                else:
+                    x += dx * t
+                    y = hit.top - h if dy > 0 else hit.bottom
+                    blocked_y = 1 if dy > 0 else -1
+                    dx, dy = dx * (1 - t), 0
+        x += dx
+        y += dy
+        pos[0], pos[1] = x, y
+        rect.topleft = (x, y)
+        return blocked_x, blocked_y
+
+    def spritecollide(self, sprite: pg.sprite.Sprite, dokill: bool) -> list[pg.sprite.Sprite]:
+        """
+        pg.sprite.spritecollideと同じ結果を返す
+        sprite: 判定するスプライト
+        dokill: 衝突したスプライトを削除するかどうか
+        返り値: 衝突したスプライトのリスト
+        """
+        if not USE_SPATIAL_HASH:
+            return pg.sprite.spritecollide(sprite, self.group, dokill)
+        hits = self.query(sprite.rect)
+        if dokill:
+            for s in hits:
+                self.remove(s)
+                s.kill()
+        return hits
+
+    def groupcollide(self, groupa: pg.sprite.AbstractGroup, dokilla: bool, dokillb: bool) -> dict:
+        """
+        pg.sprite.groupcollide(groupa, self.group, ...)と同じ結果を返す
+        groupa: 判定するグループ
+        dokilla: 衝突したgroupaのスプライトを削除するかどうか
+        dokillb: 衝突したself.groupのスプライトを削除するかどうか
+        返り値: groupaのスプライトをキー, 衝突したスプライトのリストを値とする辞書
+        """
+        if not USE_SPATIAL_HASH:
+            return pg.sprite.groupcollide(groupa, self.group, dokilla, dokillb)
+        crashed = {}
+        for a in groupa.sprites():
+            c = self.spritecollide(a, dokillb)
+            if c:
+                crashed[a] = c
+                if dokilla:
+                    a.kill()
+        return crashed
+
+class InputSnapshot(NamedTuple):
+    """
+    1回の更新で使う入力の状態(変更不可)
+    keys: 押されているキーの集合(InputSource.watch_keysのうち押されているもの)
+    mouse: 押されているマウスボタンのタプル
+    mouse_pos: マウスの画面座標
+    pressed: 前の更新から新たに押されたキーの集合
+    """
+    keys: frozenset = frozenset()
+    mouse: tuple[bool, bool, bool] = (False, False, False)
+    mouse_pos: tuple[int, int] = (0, 0)
+    pressed: frozenset = frozenset()
+
 
-# スクロールのために動的に変更されるrectのリスト
-dynamic_rect_lst = []
+class InputSource:
+    """
+    イベントキューを1フレームに1回だけ取り出し, 更新ごとの入力の状態を作るクラス
+    押された瞬間のキーは次にsnapshotを作るまで溜めておくため, 更新が行われないフレームでも失われない
+    """
+    # ゲームが使うキー
+    watch_keys = (
+        pg.K_LEFT, pg.K_a, pg.K_RIGHT, pg.K_d, pg.K_UP, pg.K_w, pg.K_SPACE,
+        pg.K_LCTRL, pg.K_RCTRL, pg.K_LSHIFT, pg.K_RSHIFT,
+    )
+
+    def __init__(self):
+        """
+        InputSourceクラスの初期化
+        """
+        self.quit = False   # 終了が要求されたかどうか
+        self.__pressed = set()
+
+    def pump(self):
+        """
+        イベントキューを取り出し, 終了要求と押された瞬間のキーを記録する
+        """
+        for event in pg.event.get():
+            if event.type == pg.QUIT:
+                self.quit = True
+            elif event.type == pg.KEYDOWN:
+                self.__pressed.add(event.key)
+
+    def snapshot(self) -> InputSnapshot:
+        """
+        現在の入力の状態を作る. 溜めていた押された瞬間のキーはここで消費する
+        返り値: 入力の状態
+        """
+        key_lst = pg.key.get_pressed()
+        pressed, self.__pressed = frozenset(self.__pressed), set()
+        return InputSnapshot(
+            frozenset(k for k in __class__.watch_keys if key_lst[k]),
+            tuple(pg.mouse.get_pressed()),
+            pg.mouse.get_pos(),
+            pressed,
+        )
+
+
+class InputReplay:
+    """
+    記録した入力の状態を順に返すクラス(ファイルの読み書きはInputLogで行う)
+    """
+    def __init__(self, snapshots: list[InputSnapshot]):
+        """
+        InputReplayクラスの初期化
+        snapshots: 更新ごとの入力の状態のリスト
+        """
+        self.snapshots = snapshots
+        self.__index = 0
+
+    @property
+    def is_finished(self) -> bool:
+        """
+        すべての入力を返し終えたかどうか
+        """
+        return self.__index >= len(self.snapshots)
+
+    def snapshot(self) -> InputSnapshot:
+        """
+        次の入力の状態を返す. 返し終えた後は何も押されていない状態を返す
+        返り値: 入力の状態
+        """
+        if self.is_finished:
+            return InputSnapshot()
+        self.__index += 1
+        return self.snapshots[self.__index - 1]
+
+class InputLog:
+    """
+    1回のプレイの乱数のシードと更新ごとの入力, 終了時の結果を記録するクラス
+    ファイルはヘッダ(識別子, 版, シード, フレーム数), フレームごとの固定長の入力, 結果のJSONの順に並べたバイナリ
+    キーはInputSource.watch_keysのうち押されているものをビット列として記録する
+    """
+    magic = b"HKTM"
+    version = 1
+    __header = struct.Struct("<4sBQI")  # 識別子, 版, シード, フレーム数
+    __frame = struct.Struct("<HBhhH")   # 押されているキー, マウスボタン, マウスのx, y座標, 押された瞬間のキー
+
+    def __init__(self, seed: int, snapshots: list[InputSnapshot] = None, result: dict = None):
+        """
+        InputLogクラスの初期化
+        seed: Levelなどが使う乱数のシード
+        snapshots: 更新ごとの入力の状態のリスト
+        result: 終了時の結果(Game.summaryの返り値)
+        """
+        self.seed = seed
+        self.snapshots = [] if snapshots is None else snapshots
+        self.result = result
+
+    def append(self, snapshot: InputSnapshot):
+        """
+        1回の更新の入力を記録する
+        snapshot: 入力の状態
+        """
+        self.snapshots.append(snapshot)
+
+    def finish(self, game: "Game"):
+        """
+        終了時の結果を記録する
+        game: 記録したゲーム
+        """
+        self.result = game.summary()
+
+    def verify(self, game: "Game") -> list[str]:
+        """
+        再生したゲームの結果が記録と一致するか調べる
+        game: 再生したゲーム
+        返り値: 一致しなかった項目の説明のリスト(一致すれば空)
+        """
+        if self.result is None:
+            return ["記録に結果がありません"]
+        result = game.summary()
+        return [f"{k}: 記録 {self.result.get(k)}, 再生 {v}" for k, v in result.items() if self.result.get(k) != v]
+
+    @staticmethod
+    def __to_bits(keys: frozenset) -> int:
+        return sum(1 << i for i, k in enumerate(InputSource.watch_keys) if k in keys)
+
+    @staticmethod
+    def __from_bits(bits: int) -> frozenset:
+        return frozenset(k for i, k in enumerate(InputSource.watch_keys) if bits >> i & 1)
+
+    def save(self, path: str):
+        """
+        ファイルに保存する
+        path: ファイルのパス
+        """
+        to_bits, pack = __class__.__to_bits, __class__.__frame.pack
+        with open(path, "wb") as f:
+            f.write(__class__.__header.pack(__class__.magic, __class__.version, self.seed, len(self.snapshots)))
+            f.write(b"".join(
+                pack(to_bits(s.keys), s.mouse[0] | s.mouse[1] << 1 | s.mouse[2] << 2, *s.mouse_pos, to_bits(s.pressed))
+                for s in self.snapshots
+            ))
+            if self.result is not None:
+                f.write(json.dumps(self.result).encode())
+
+    @classmethod
+    def load(cls, path: str) -> "InputLog":
+        """
+        ファイルから読み込む
+        path: ファイルのパス
+        返り値: InputLog
+        """
+        with open(path, "rb") as f:
+            data = f.read()
+        magic, version, seed, frames = cls.__header.unpack_from(data)
+        if magic != cls.magic or version != cls.version:
+            raise ValueError(f"{path}は入力の記録ではありません")
+        start = cls.__header.size
+        end = start + frames * cls.__frame.size
+        from_bits = cls.__from_bits
+        snapshots = [
+            InputSnapshot(from_bits(keys), (bool(mouse & 1), bool(mouse & 2), bool(mouse & 4)), (x, y), from_bits(pressed))
+            for keys, mouse, x, y, pressed in cls.__frame.iter_unpack(data[start:end])
+        ]
+        result = json.loads(data[end:]) if len(data) > end else None
+        return cls(seed, snapshots, result)
 
 class Player(pg.sprite.Sprite):
     """
@@ -36,11 +778,13 @@ class Player(pg.sprite.Sprite):
         self.image.fill((255, 255, 255))
         self.rect = self.image.get_rect()
         self.rect.center = center
+        self.pos = list(self.rect.topleft)  # 小数の位置(rectは四捨五入したもの)
+        self.prev_pos = self.rect.topleft   # 前の更新での位置(補間描画用)
         self.my_timer = 0
         self.box_timer = 0
-        self.curve_timer = 0
         self.is_predict = False
         self.is_pre_predict = False
+        self.preview = TrajectoryPreview()
         self.__acc = [.0, .0]
         self.__vel = [.0, .0]
         self.__gravity_acc = 1
@@ -121,20 +865,20 @@ class Player(pg.sprite.Sprite):
                 self.image.fill((255, 255, 255)) # プレイヤーの色を元に戻す
 
 
-    def update(self, key_lst: dict):
+    def update(self, inputs: InputSnapshot):
         """
         Playerの更新を行う
-        key_lst: 押されているキーのリスト
+        inputs: 入力の状態
         """
         
         self.my_timer += 1
-        self.update_box(key_lst)
-        self.update_bomb(key_lst)
-        self.update_throw_predict(key_lst)
+        self.update_box(inputs)
+        self.update_bomb(inputs)
+        self.update_throw_predict(inputs)
         self.__acc = [.0, .0]
         # 入力と移動方向dictに応じて加速度を設定
         for d in __class__.__move_dict:
-            if key_lst[d]:
+            if d in inputs.keys:
                 self.__acc[0] += self.__walk_acc * __class__.__move_dict[d][0]
                 # 接地時のみジャンプ可能
                 if self.is_grounded:
@@ -157,7 +901,7 @@ class Player(pg.sprite.Sprite):
         self.check_hyper()
         
     
-    def update_box(self,key_lst: dict):
+    def update_box(self, inputs: InputSnapshot):
         """
         Press mouse Left
         box throw 
@@ -167,20 +911,18 @@ class Player(pg.sprite.Sprite):
         if self.my_timer - self.box_timer < 10:
             return
         
-        
-        pg.event.get()
-        if pg.mouse.get_pressed()[0]:
+        if inputs.mouse[0]:
             self.box_timer = self.my_timer
             throw_arg = [0,0]
-            mouse_pos = list(pg.mouse.get_pos())
-            player_pos = list(self.rect.center)
+            mouse_pos = list(inputs.mouse_pos)
+            player_pos = list(camera.apply(self.rect).center)
             throw_arg[0] = (mouse_pos[0] - player_pos[0])/15
             throw_arg[1] = (mouse_pos[1] - player_pos[1])/15
-            Box((self.rect.centerx + throw_arg[0],self.rect.centery - 10 + throw_arg[1]),tuple(throw_arg),power=2.0)
+            Box.spawn((self.rect.centerx + throw_arg[0],self.rect.centery - 10 + throw_arg[1]),tuple(throw_arg),power=2.0)
             
             
             
-    def update_bomb(self,key_lst: dict):
+    def update_bomb(self, inputs: InputSnapshot):
         """
         Press mouse Riglt
         bomb throw 
@@ -190,55 +932,49 @@ class Player(pg.sprite.Sprite):
         if self.my_timer - self.box_timer < 30:
             return
         
-        
-        pg.event.get()
-        if pg.mouse.get_pressed()[2]:
+        if inputs.mouse[2]:
             self.box_timer = self.my_timer
             throw_arg = [0,0]
-            mouse_pos = list(pg.mouse.get_pos())
-            player_pos = list(self.rect.center)
+            mouse_pos = list(inputs.mouse_pos)
+            player_pos = list(camera.apply(self.rect).center)
             throw_arg[0] = (mouse_pos[0] - player_pos[0])/15
             throw_arg[1] = (mouse_pos[1] - player_pos[1])/15
-            Bomb(self.rect.center,tuple(throw_arg),power=2.0)
+            Bomb.spawn(self.rect.center,tuple(throw_arg),power=2.0)
             
-    def update_throw_predict(self,key_lst: dict):
+    def update_throw_predict(self, inputs: InputSnapshot):
         """
         Press Shift
         draw throw curve 
         """        
-        pg.event.get()
         #CTRLで予測線
-        if (key_lst[pg.K_RCTRL] or key_lst[pg.K_LCTRL]):
+        if pg.K_RCTRL in inputs.keys or pg.K_LCTRL in inputs.keys:
             if not self.is_pre_predict:
                 self.is_predict = not self.is_predict
                 self.is_pre_predict = True
         else:
             self.is_pre_predict = False
         
-        #次に投げれるようになるまでのフレーム数
-        if self.my_timer - self.curve_timer < 10:
-            return
-        
         if self.is_predict:
-            self.curve_timer = self.my_timer
             throw_arg = [0,0]
-            mouse_pos = list(pg.mouse.get_pos())
-            player_pos = list(self.rect.center)
+            mouse_pos = list(inputs.mouse_pos)
+            player_pos = list(camera.apply(self.rect).center)
             throw_arg[0] = (mouse_pos[0] - player_pos[0])/15
             throw_arg[1] = (mouse_pos[1] - player_pos[1])/15
-            Throw_predict(self.rect.center,tuple(throw_arg),power=2.0)
+            self.preview.aim(tuple(throw_arg))
+        else:
+            self.preview.hide()
 
 class Block(pg.sprite.Sprite):
     """
     初期生成されるブロックに関するクラス
+    描画はChunkにまとめて行うため, 衝突判定用のrectのみを持つ
     """
     def __init__(self, center: tuple[int, int], size: tuple[int, int]):
         super().__init__()
         self.__size = size
-        self.image = pg.Surface(size)
-        self.image.fill((127, 127, 127))
-        self.rect = self.image.get_rect()
+        self.rect = pg.Rect((0, 0), size)
         self.rect.center = center
+        registry.register("block", self)
 
     @property
     def size(self) -> tuple[int, int]:
@@ -248,312 +984,1139 @@ class Block(pg.sprite.Sprite):
         """
         return self.__size
 
-class Box(pg.sprite.Sprite):
+    def kill(self):
+        """
+        全てのGroupから取り除き, 上で眠っているBoxを起こす
+        """
+        super().kill()
+        Box.wake_dependents(self)
+
+class Pool:
     """
-    playerがなげるBoxClassです
+    killされたスプライトを取っておき, 次の生成で使い回すクラス
+    生存数が上限に達していれば, 生成の前に方針に従って既存のものを消す
     """
-    boxes = pg.sprite.Group()
-    def __init__(self, pos: tuple[int, int],vel:tuple[float,float],power:float=5):
-        global dynamic_rect_lst
+    def __init__(self, group: pg.sprite.AbstractGroup, cap: int = None, eviction: str = "oldest"):
+        """
+        Poolクラスの初期化
+        group: 生存しているスプライトのグループ(生成順)
+        cap: 生存数の上限(Noneで上限なし)
+        eviction: 上限に達したときに消すもの("oldest"または"farthest")
+        """
+        self.group = group
+        self.cap = cap
+        self.eviction = eviction
+        self.free = []      # 使い回せるスプライト
+        self.evicted = 0    # 上限に達して消した数
+
+    def acquire(self) -> pg.sprite.Sprite:
+        """
+        使い回せるスプライトを取り出す
+        上限に達していれば先に既存のものを消す
+        返り値: 使い回すスプライト(なければNone)
+        """
+        if self.cap is not None:
+            while len(self.group) > 0 and len(self.group) >= self.cap:
+                self.evict()
+        return self.free.pop() if self.free else None
+
+    def release(self, sprite: pg.sprite.Sprite):
+        """
+        killされたスプライトを使い回せるようにする
+        sprite: killされたスプライト
+        """
+        if self.cap is None or len(self.free) < self.cap:
+            self.free.append(sprite)
+
+    def evict(self):
+        """
+        方針に従って生存しているスプライトを1つ消す
+        """
+        if self.eviction == "farthest":
+            cx, cy = camera.to_world((WIDTH // 2, HEIGHT // 2))
+            victim = max(self.group, key=lambda s: (s.rect.centerx - cx) ** 2 + (s.rect.centery - cy) ** 2)
+        else:
+            victim = next(iter(self.group))
+        victim.kill()
+        self.evicted += 1
+
+class Pooled:
+    """
+    spawnで生成し, killしたものをPoolに戻して使い回すためのMixin
+    サブクラスはpoolと, __init__と同じ引数で状態を初期化するresetを持つ
+    """
+    pool = None
+
+    @classmethod
+    def spawn(cls, *args, **kwargs):
+        """
+        プールのものを使い回して生成する(なければ新しく作る)
+        返り値: 生成したスプライト
+        """
+        sprite = cls.pool.acquire()
+        if sprite is None:
+            return cls(*args, **kwargs)
+        sprite.reset(*args, **kwargs)
+        return sprite
+
+    def kill(self):
+        """
+        全てのGroupから取り除き, プールに戻す
+        """
+        was_alive = self.alive()
+        super().kill()
+        if was_alive:
+            type(self).pool.release(self)
+
+class Projectile(pg.sprite.Sprite):
+    """
+    重力で飛んでいくもの(Box, Bomb)の基底クラス
+    """
+    rest_on_ground = True   # 接地したら完全に止めるか(Falseならx方向だけ止め, 重力で接地し続けているか確かめる)
+    fall_limit = HEIGHT * 2 # これより下(ワールド座標)に落ちたものはレベルに戻れないので消す
+    def __init__(self, kind: str, size: tuple[int, int], color: tuple[int, int, int]):
+        """
+        Projectileクラスの初期化
+        状態の初期化はresetで行う
+        kind: スプライトの種類(画像のキャッシュのキー)
+        size: 大きさ
+        color: 色
+        """
         super().__init__()
-        self.image = pg.Surface((50, 50))
-        self.image.fill((0, 255, 255))
+        self.kind = kind
+        self.color = color
+        self.image = image_cache.get(kind, size, color)
         self.rect = self.image.get_rect()
-        self.rect.center = pos
         self.gravity_val = 1
+
+    def reset(self, pos: tuple[int, int], vel: tuple[float, float]):
+        """
+        状態を初期化する(使い回すときにも呼ぶ)
+        pos: 中心座標
+        vel: 初速度
+        """
+        self.image = image_cache.get(self.kind, self.rect.size, self.color)
+        self.rect.center = pos
+        self.pos = list(self.rect.topleft)  # 小数の位置(rectは四捨五入したもの)
+        self.prev_pos = self.rect.topleft   # 前の更新での位置(補間描画用)
         self.life = 0
         self.is_ground = False
         self.vel = list(vel)
-        self.acc = [0,0]
-        self.acc = [0,self.gravity_val]
-        __class__.boxes.add(self)
-        dynamic_rect_lst.append(self.rect)
-        
+        self.acc = [0, self.gravity_val]
 
-    def update(self):
-        
-        self.life += 1
-        if self.life > 6000:
-            self.kill()
+    def set_vel(self,vx,vy):
+        self.vel[1] = vy
+        self.vel[0] = vx
+
+    def accelerate(self):
+        """
+        速度に加速度を足し, 接地していれば止める
+        位置はブロックとの衝突判定(SpatialHash.sweep)で動かす
+        """
         self.vel[0] += self.acc[0]
         self.vel[1] += self.acc[1]
         
-        
-        
         if self.is_ground:
-            self.vel[1] = 0
             self.vel[0] = 0
-        
-        self.rect.x += self.vel[0]
-        self.rect.y += self.vel[1]
-        
-    def set_vel(self,vx,vy):
-        self.vel[1] = vy
-        self.vel[0] = vx
-    
-    def is_moving(self):
-        #[0,0]でないならFalse
-        return not self.vel == [0,0]
+            if self.rest_on_ground:
+                self.vel[1] = 0
+
+    @staticmethod
+    def clear_ground(group: pg.sprite.AbstractGroup):
+        """
+        全ての接地判定をFalseにする
+        group: 対象のGroup
+        """
+        for i in group:
+            i.is_ground = False
 
-class Bomb(pg.sprite.Sprite):
+class Box(Pooled, Projectile):
     """
-    playerがなげるBombClassです
+    playerがなげるBoxClassです
+    静止したBoxは眠らせ, 起きるまで移動と衝突判定(動かす側)から外す
     """
-    bombs = pg.sprite.Group()
+    boxes = pg.sprite.Group()
+    awake = pg.sprite.Group()   # 眠っていないBox
+    dependents = {}     # 支えているスプライト -> その上で眠っているBox(順序を保つため辞書のキーで持つ)
+    life_max = 6000
+    sleep_frames = 10   # 何フレーム静止したら眠らせるか
+    frame = 0   # update_allを呼んだ回数(眠っている間の寿命の計算に使う)
+    pool = Pool(boxes, MAX_BOXES, ENTITY_EVICTION)
+    rest_on_ground = False  # 重力で毎フレーム床に押し付け, 接地し続けているか確かめる
+    friction = 0.3  # 接地したときにx方向の速度に掛ける値
     def __init__(self, pos: tuple[int, int],vel:tuple[float,float],power:float=5):
-        global dynamic_rect_lst
-        super().__init__()
-        self.image = pg.Surface((30, 30))
-        self.image.fill((255, 128, 0))
-        self.rect = self.image.get_rect()
-        #self.image.set_alpha(128)
-        self.rect.center = pos
-        self.gravity_val = 1
-        self.life = 0
-        self.is_ground = False
-        self.vel = list(vel)
-        self.acc = [0,0]
-        self.acc = [0,self.gravity_val]
+        super().__init__("box", (50, 50), (0, 255, 255))
+        self.reset(pos, vel, power)
+
+    def reset(self, pos: tuple[int, int],vel:tuple[float,float],power:float=5):
+        super().reset(pos, vel)
+        self.is_sleeping = False
+        self.frozen_chunk = None    # 退避で眠らせたチャンクの番号(再読み込みまで起きない. 眠らせていなければNone)
+        self.rest_frames = 0    # 静止しているフレーム数(0なら動いている)
+        self.last_pos = self.rect.topleft
+        self.supports = []      # 眠っている間, 下で支えているスプライト
+        self.sleep_frame = 0    # 眠ったときのframe
+        __class__.boxes.add(self)
+        __class__.awake.add(self)
+        registry.register("box", self)
+        
+
+    def update(self):
+        
+        self.life += 1
+        if self.life > __class__.life_max:
+            self.kill()
+        self.accelerate()
+
+    def lifetime(self) -> int:
+        """
+        生成されてからのフレーム数(眠っている間も数える)
+        返り値: フレーム数
+        """
+        if self.is_sleeping:
+            return self.life + __class__.frame - self.sleep_frame
+        return self.life
+
+    @classmethod
+    def update_all(cls):
+        """
+        眠っていない全てのBoxを1フレーム進める
+        """
+        cls.frame += 1
+        # 生成順に並んでいるので, 古いものから寿命を確認する(眠っているものも寿命で消える)
+        expired = []
+        for box in cls.boxes:
+            if box.lifetime() < cls.life_max:
+                break
+            expired.append(box)
+        for box in expired:
+            box.kill()
+        cls.awake.update()
+
+    def sleep(self, supports: list[pg.sprite.Sprite]):
+        """
+        Boxを眠らせる
+        supports: 下で支えているスプライト(これが消えたり動いたりすると起きる)
+        """
+        self.is_sleeping = True
+        self.set_vel(0, 0)
+        # 眠っている間は補間描画で前の位置からずれて見えないようにする
+        self.prev_pos = self.rect.topleft
+        self.sleep_frame = __class__.frame
+        self.supports = supports
+        for s in supports:
+            __class__.dependents.setdefault(s, {})[self] = None
+        __class__.awake.remove(self)
+
+    def wake(self):
+        """
+        眠っているBoxを起こす(freezeで眠らせたものは起こさない)
+        上で眠っているBoxは, このBoxが実際に動いたときにsettleで起こす
+        """
+        if not self.is_sleeping or self.frozen_chunk is not None:
+            return
+        self.is_sleeping = False
+        self.__release_supports()
+        self.life += __class__.frame - self.sleep_frame
+        # 動くまでは静止しているものとして扱い, 触れているBoxを起こさない
+        self.rest_frames = 1
+        self.last_pos = self.rect.topleft
+        # 眠っていた間の古い位置から補間しないようにする
+        self.prev_pos = self.rect.topleft
+        __class__.awake.add(self)
+
+    def __release_supports(self):
+        """
+        支えているスプライトへの登録を解除する
+        """
+        for s in self.supports:
+            sleepers = __class__.dependents.get(s)
+            if sleepers is not None:
+                sleepers.pop(self, None)
+                if not sleepers:
+                    del __class__.dependents[s]
+        self.supports = []
+
+    def kill(self):
+        """
+        全てのGroupから取り除き, 上で眠っているBoxを起こす
+        """
+        self.__release_supports()
+        super().kill()
+        __class__.wake_dependents(self)
+
+    @classmethod
+    def wake_dependents(cls, sprite: pg.sprite.Sprite):
+        """
+        spriteの上で眠っているBoxを起こす
+        sprite: 支えているスプライト
+        """
+        sleepers = cls.dependents.pop(sprite, None)
+        if sleepers:
+            for box in list(sleepers):
+                box.wake()
+
+    @classmethod
+    def freeze(cls, index: int, blocks: pg.sprite.AbstractGroup, left: int, right: int) -> list["Box"]:
+        """
+        チャンクを退避する前に呼び, x座標の範囲に中心があるBoxをthawまで起きないように眠らせる
+        blocksが消えても, 爆風や他のBoxに触れても起きないため, 積んだBoxは落ちずにその場に残る
+        index: 退避するチャンクの番号
+        blocks: 消えるブロック
+        left: 範囲の左端のx座標
+        right: 範囲の右端のx座標(含まない)
+        返り値: 範囲のBoxのリスト(チャンクを再読み込みしたらthawに渡す)
+        """
+        for b in blocks:
+            cls.dependents.pop(b, None)
+        frozen = [box for box in cls.boxes if left <= box.rect.centerx < right]
+        for box in frozen:
+            if not box.is_sleeping:
+                box.sleep([])
+            box.frozen_chunk = index
+        return frozen
+
+    @staticmethod
+    def thaw(index: int, boxes: list["Box"]):
+        """
+        freezeで眠らせたBoxを起こし, 再読み込みしたブロックの上でもう一度眠らせる
+        index: 再読み込みしたチャンクの番号
+        boxes: freezeが返したBoxのリスト
+        """
+        for box in boxes:
+            # 消えて使い回されたBoxは, 別のチャンクで眠らされていても起こさない
+            if box.alive() and box.frozen_chunk == index:
+                box.frozen_chunk = None
+                box.wake()
+
+    @classmethod
+    def settle(cls, block_index: SpatialHash, box_index: SpatialHash):
+        """
+        衝突判定のあとに呼び, sleep_frames フレーム動かず, 下に支えがあるBoxを眠らせる
+        動いたBoxの上で眠っているBoxは起こす
+        block_index: ブロックのSpatialHash
+        box_index: BoxのSpatialHash
+        """
+        for box in cls.awake.sprites():
+            pos = box.rect.topleft
+            # 重なったBox同士は押し戻し合って1px上下するため, 静止し始めた位置から1px以内なら静止とみなす
+            # 静止し始めた位置は更新しないので, 少しずつずれていくものは動いているとみなされる
+            moved = abs(pos[0] - box.last_pos[0]) > 1 or abs(pos[1] - box.last_pos[1]) > 1
+            if moved or abs(box.vel[0]) >= 0.5 or box.vel[1] != 0:
+                box.rest_frames = 0
+                box.last_pos = pos
+                cls.wake_dependents(box)
+                continue
+            box.rest_frames += 1
+            if box.rest_frames >= cls.sleep_frames:
+                # 底辺のすぐ下にあるものを支えとする
+                below = pg.Rect(box.rect.left, box.rect.bottom - 1, box.rect.width, 2)
+                supports = block_index.query(below) + [b for b in box_index.query(below) if b is not box]
+                if supports:
+                    box.sleep(supports)
+
+class Bomb(Pooled, Projectile):
+    """
+    playerがなげるBombClassです
+    """
+    bombs = pg.sprite.Group()
+    pool = Pool(bombs, MAX_BOMBS, ENTITY_EVICTION)
+    life_max = 180  # 自動で消えるまでの時間
+    fuse_step = 1   # 導火線の色を変える間隔(フレーム)
+    fuse_images = None  # 寿命の区間ごとの導火線の色の画像(最初に使うときに作る)
+    def __init__(self, pos: tuple[int, int],vel:tuple[float,float],power:float=5):
+        super().__init__("bomb", (30, 30), (255, 128, 0))
+        #self.image.set_alpha(128)
+        self.reset(pos, vel, power)
+
+    def reset(self, pos: tuple[int, int],vel:tuple[float,float],power:float=5):
+        super().reset(pos, vel)
         __class__.bombs.add(self)
-        dynamic_rect_lst.append(self.rect)
+        registry.register("bomb", self)
+
+    @staticmethod
+    def fuse_color(life: int) -> tuple[float, float, float]:
+        """
+        爆発までの時間を表す色
+        life: 生成されてからのフレーム数
+        返り値: 色
+        """
+        life_max = __class__.life_max
+        return (255 - 128*int((life/life_max/120)), 128 * (1 - life/life_max), 255 * (life/life_max)**2)
+
+    @classmethod
+    def fuse_image(cls, life: int) -> pg.Surface:
+        """
+        爆発までの時間を色で表した画像
+        life: 生成されてからのフレーム数
+        返り値: 共有の画像
+        """
+        if cls.fuse_images is None:
+            cls.fuse_images = [image_cache.get("bomb", (30, 30), cls.fuse_color(i * cls.fuse_step))
+                               for i in range(cls.life_max // cls.fuse_step + 1)]
+        return cls.fuse_images[min(life // cls.fuse_step, len(cls.fuse_images) - 1)]
 
     def update(self):
-        life_max = 180
         self.life += 1
         
         #自動で消えるまでの時間
-        if self.life >= life_max:
-            Explode(self.rect.center)
+        if self.life >= __class__.life_max:
+            Explode.spawn(self.rect.center)
             self.kill()
             
         #爆発までの時間を色で表現
-        self.image.fill((255 - 128*int((self.life/life_max/120)), 128 * (1 - self.life/life_max), 255 * (self.life/life_max)**2))
-        
-        self.vel[0] += self.acc[0]
-        self.vel[1] += self.acc[1]
-        
-        
-        
-        if self.is_ground:
-            self.vel[1] = 0
-            self.vel[0] = 0
-        
-        self.rect.x += self.vel[0]
-        self.rect.y += self.vel[1]
-        
-    def set_vel(self,vx,vy):
-        self.vel[1] = vy
-        self.vel[0] = vx
+        self.image = __class__.fuse_image(self.life)
+        self.accelerate()
+
+    @classmethod
+    def update_all(cls):
+        """
+        全てのBombを1フレーム進める
+        """
+        cls.bombs.update()
         
-class Explode(pg.sprite.Sprite):
+class Explode(Pooled, pg.sprite.Sprite):
     """
     Bombが爆発した時に呼び出されるExplodeClassです
     """
     explodes = pg.sprite.Group()
+    pool = Pool(explodes, MAX_EXPLODES, ENTITY_EVICTION)
     def __init__(self, pos: tuple[int, int],power:float=7):
-        global dynamic_rect_lst
         super().__init__()
-        rad = power * 16
-        self.image = pg.Surface((rad, rad))
-        self.image.fill((200, 0, 0))
-        pg.draw.circle(self.image, (200, 0, 0), (rad, rad), rad)
-        self.image.set_colorkey((255, 255, 255))
-        self.image.set_alpha(128)
-        self.rect = self.image.get_rect()
+        self.power = None
+        self.reset(pos, power)
+
+    def reset(self, pos: tuple[int, int],power:float=7):
+        if power != self.power:
+            self.power = power
+            rad = power * 16
+            self.image = image_cache.get("explode", (rad, rad), (200, 0, 0), __class__.draw_image)
+            self.rect = self.image.get_rect()
+            self.radius = rad / 2   # 爆風の円の半径
         self.rect.center = pos
         self.life = 0
         __class__.explodes.add(self)
-        dynamic_rect_lst.append(self.rect)
+        registry.register("explode", self)
+
+    @staticmethod
+    def draw_image(surface: pg.Surface, color: tuple[int, int, int]):
+        """
+        爆発の画像を描く(ImageCacheで1度だけ呼ばれる)
+        surface: 描画先のSurface
+        color: 色
+        """
+        rad = surface.get_width() // 2
+        surface.fill((255, 255, 255))
+        pg.draw.circle(surface, color, (rad, rad), rad)
+        surface.set_colorkey((255, 255, 255))
+        surface.set_alpha(128)
 
     def update(self):
         self.life += 1
         #自動で消えるまでの時間
         if self.life > 12:
             self.kill()
-          
-class Throw_predict(pg.sprite.Sprite):
+
+class ExplosionField:
+    """
+    全てのExplodeの爆風を1フレームに1度まとめて, Box, Bomb, playerへの衝撃を合計するクラス
+    爆風は半径radiusの円で, 円の中心から対象のrectまでの距離が0で最も強く, 円の縁で0になる
+    衝撃の向きは円の中心から対象のrectの中心へ向かう向き
+    対象は爆風の円の外接正方形(rect)で探し(SpatialHashがあればそこから), 組が多ければnumpyでまとめて計算する(numpyがなければ1組ずつ計算する)
+    """
+    box_strength = 4.0      # Box, Bombへの半径1あたりの最大の衝撃(従来の平均の強さと同じくらい)
+    player_strength = 2 / 3 # playerへの半径1あたりの最大の衝撃
+    numpy_pairs = 200       # この数以上の組があればnumpyで計算する(少ないと配列を作る分だけ遅い)
+
+    def __init__(self):
+        """
+        ExplosionFieldクラスの初期化
+        """
+        self.pairs = 0  # 直近のフレームで円の外接正方形が重なった(爆発, 対象)の組の数
+
+    def impulses(self, explodes: list[Explode], indexes: list[tuple[SpatialHash, float]],
+                 others: list[tuple[list[pg.sprite.Sprite], float]] = ()) -> list[tuple[pg.sprite.Sprite, float, float]]:
+        """
+        全ての爆風から各対象が受ける衝撃の合計を求める
+        explodes: 爆発のリスト
+        indexes: (対象を登録したSpatialHash, 半径1あたりの最大の衝撃)のリスト
+        others: SpatialHashに登録していない(対象のリスト, 半径1あたりの最大の衝撃)のリスト(毎フレーム動く少数のもの)
+        返り値: 衝撃を受ける対象とx, y方向の衝撃のタプルのリスト(indexesの順にそれぞれの登録順, 続けてothersの順にリストの順)
+        """
+        targets, strengths, kinds = [], [], []
+        numbers = {}    # 対象 -> targetsでの番号
+        hits = []
+        other_rects = [[s.rect for s in sprites] for sprites, _ in others]
+        for e in explodes:
+            # 合計は爆発の順に足すため, 爆発ごとの候補の順序は結果に影響しない
+            found = [(k, s, strength) for k, (index, strength) in enumerate(indexes) for s in index.candidates(e.rect)]
+            for k, ((sprites, strength), rects) in enumerate(zip(others, other_rects), len(indexes)):
+                found += [(k, sprites[i], strength) for i in e.rect.collidelistall(rects)]
+            hit = []
+            for k, s, strength in found:
+                t = numbers.get(s)
+                if t is None:
+                    t = numbers[s] = len(targets)
+                    targets.append(s)
+                    strengths.append(strength)
+                    kinds.append(k)
+                hit.append(t)
+            hits.append(hit)
+        self.pairs = sum(map(len, hits))
+        if self.pairs == 0:
+            return []
+        rects = [s.rect for s in targets]
+        if np is not None and self.pairs >= __class__.numpy_pairs:
+            totals = __class__.__impulses_numpy(explodes, rects, strengths, hits)
+        else:
+            totals = __class__.__impulses_python(explodes, rects, strengths, hits)
+        # 対象の種類ごとに, 総当たり判定と同じ順序に並べる
+        impulse = {targets[t]: (ix, iy) for t, ix, iy in totals}
+        groups = [[] for _ in indexes]
+        for t, _, _ in totals:
+            if kinds[t] < len(indexes):
+                groups[kinds[t]].append(targets[t])
+        ordered = [s for (index, _), g in zip(indexes, groups) for s in index.sort(g)]
+        ordered += [s for sprites, _ in others for s in sprites if s in impulse]
+        return [(s, *impulse[s]) for s in ordered]
+
+    @staticmethod
+    def __impulses_python(explodes: list[Explode], rects: list[pg.Rect], strengths: list[float],
+                          hits: list[list[int]]) -> list[tuple[int, float, float]]:
+        """
+        impulsesの組ごとの計算を1組ずつ行う
+        返り値: 衝撃を受ける対象の番号とx, y方向の衝撃のタプルの番号順のリスト
+        """
+        n = len(rects)
+        total_x, total_y = [0.0] * n, [0.0] * n
+        touched = set()
+        for e, hit in zip(explodes, hits):
+            # 円の外接正方形(rect)が重ならない爆発は飛ばす
+            if not hit:
+                continue
+            cx, cy = e.rect.center
+            radius = e.radius
+            radius2 = radius * radius
+            for t in hit:
+                left, top, w, h = rects[t]
+                # 円の中心に最も近いrect上の点までの距離
+                qx = min(max(cx, left), left + w) - cx
+                qy = min(max(cy, top), top + h) - cy
+                q2 = qx * qx + qy * qy
+                if q2 >= radius2:
+                    continue
+                dx, dy = left + w // 2 - cx, top + h // 2 - cy
+                d = math.sqrt(dx * dx + dy * dy)
+                mag = strengths[t] * (radius - math.sqrt(q2))
+                # 中心が重なっていれば真上に飛ばす
+                if d > 0:
+                    total_x[t] += mag * (dx / d)
+                    total_y[t] += mag * (dy / d)
+                else:
+                    total_y[t] -= mag
+                touched.add(t)
+        return [(t, total_x[t], total_y[t]) for t in sorted(touched)]
+
+    @staticmethod
+    def __impulses_numpy(explodes: list[Explode], rects: list[pg.Rect], strengths: list[float],
+                         hits: list[list[int]]) -> list[tuple[int, float, float]]:
+        """
+        impulsesの組ごとの計算をnumpyでまとめて行う(1組ずつ計算した場合と同じ結果になる)
+        返り値: 衝撃を受ける対象の番号とx, y方向の衝撃のタプルの番号順のリスト
+        """
+        pair_e = np.repeat(np.arange(len(explodes)), [len(h) for h in hits])
+        pair_t = np.fromiter((t for h in hits for t in h), dtype=np.intp, count=len(pair_e))
+        e = np.array([(*x.rect.center, x.radius) for x in explodes], dtype=np.float64)[pair_e]
+        r = np.array([tuple(x) for x in rects], dtype=np.float64)[pair_t]
+        cx, cy, radius = e[:, 0], e[:, 1], e[:, 2]
+        left, top, w, h = r[:, 0], r[:, 1], r[:, 2], r[:, 3]
+        qx = np.minimum(np.maximum(cx, left), left + w) - cx
+        qy = np.minimum(np.maximum(cy, top), top + h) - cy
+        q2 = qx * qx + qy * qy
+        inside = q2 < radius * radius
+        pair_t, cx, cy, radius = pair_t[inside], cx[inside], cy[inside], radius[inside]
+        q = np.sqrt(q2[inside])
+        dx = left[inside] + w[inside] // 2 - cx
+        dy = top[inside] + h[inside] // 2 - cy
+        d = np.sqrt(dx * dx + dy * dy)
+        mag = np.array(strengths, dtype=np.float64)[pair_t] * (radius - q)
+        zero = d == 0
+        d[zero] = 1.0
+        ux, uy = dx / d, dy / d
+        ux[zero], uy[zero] = 0.0, -1.0
+        n = len(rects)
+        ix = np.bincount(pair_t, weights=mag * ux, minlength=n)
+        iy = np.bincount(pair_t, weights=mag * uy, minlength=n)
+        hit = np.unique(pair_t)
+        return list(zip(hit.tolist(), ix[hit].tolist(), iy[hit].tolist()))
+
+class TrajectoryPreview:
     """
     playerがなげるものの予測線Classです
+    投げる速度と重力から放物線全体を一度に計算し, ブロックに当たるところまでを折れ線で描画する
+    点のリストは使い回し, 毎フレーム作り直さない
     """
-    predicts = pg.sprite.Group()
-    def __init__(self, pos: tuple[int, int],vel:tuple[float,float],power:float=5):
-        global dynamic_rect_lst
-        super().__init__()
-        self.image = pg.Surface((15, 15))
-        self.image.fill((255, 200, 255))
-        self.rect = self.image.get_rect()
-        self.rect.center = pos
-        self.gravity_val = 1
-        self.life = 0
-        self.vel = list(vel)
-        self.acc = [0,0]
-        self.acc = [0,self.gravity_val]
-        __class__.predicts.add(self)
-        dynamic_rect_lst.append(self.rect)
+    steps = 30  # 何フレーム先まで予測するか
+    color = (255, 200, 255)
+    def __init__(self, gravity: float = 1):
+        """
+        TrajectoryPreviewクラスの初期化
+        gravity: 重力加速度(Projectile.gravity_valと同じ値)
+        """
+        self.gravity = gravity
+        self.visible = False
+        self.hit = False    # ブロックに当たったかどうか
+        self.__vel = (.0, .0)
+        # 放物線上の点(ワールド座標). 当たったあとの点は当たった点に重ねる
+        self.points = [[.0, .0] for _ in range(__class__.steps + 1)]
+        self.__screen_points = [[0, 0] for _ in range(__class__.steps + 1)]
+        self.__segment_rct = pg.Rect(0, 0, 0, 0)
+        self.__blocks = []  # 線分の近くのブロック(使い回す)
+
+    def aim(self, vel: tuple[float, float]):
+        """
+        予測線を表示する
+        vel: 投げる速度
+        """
+        self.visible = True
+        self.__vel = vel
+
+    def hide(self):
+        """
+        予測線を隠す
+        """
+        self.visible = False
+
+    def trace(self, origin: tuple[int, int], block_index: SpatialHash):
+        """
+        放物線を計算し, ブロックとの当たり判定を行う
+        Projectileと同じく速度に加速度を足してから移動するため, nフレーム後の位置は
+        x = x0 + vx*n, y = y0 + vy*n + g*n*(n+1)/2 となる
+        origin: 投げる位置
+        block_index: ブロックのSpatialHash
+        """
+        if not self.visible:
+            return
+        x0, y0 = origin
+        vx, vy = self.__vel
+        g = self.gravity
+        points = self.points
+        points[0][0] = x0
+        points[0][1] = y0
+        self.hit = False
+        end = len(points)
+        for n in range(1, len(points)):
+            p = points[n]
+            p[0] = x0 + vx * n
+            p[1] = y0 + vy * n + g * n * (n + 1) / 2
+            if self.__collide(block_index, points[n - 1], p):
+                self.hit = True
+                end = n + 1
+                break
+        # 当たったあとの点は当たった点に重ねる
+        for n in range(end, len(points)):
+            points[n][0] = points[end - 1][0]
+            points[n][1] = points[end - 1][1]
+
+    def __collide(self, block_index: SpatialHash, p0: list[float, float], p1: list[float, float]) -> bool:
+        """
+        線分p0-p1とブロックの当たり判定を行い, 当たればp1を最初に当たった点にする
+        最も近い点を選ぶため, ブロックを調べる順序は結果に影響しない
+        block_index: ブロックのSpatialHash
+        p0: 線分の始点
+        p1: 線分の終点
+        返り値: 当たったかどうか
+        """
+        rct = self.__segment_rct
+        rct.left = min(p0[0], p1[0])
+        rct.top = min(p0[1], p1[1])
+        rct.width = abs(p1[0] - p0[0]) + 1
+        rct.height = abs(p1[1] - p0[1]) + 1
+        nearest = None
+        for b in block_index.candidates(rct, self.__blocks):
+            clipped = b.rect.clipline(p0, p1)
+            if clipped:
+                x, y = clipped[0]
+                d = (x - p0[0]) ** 2 + (y - p0[1]) ** 2
+                if nearest is None or d < nearest[0]:
+                    nearest = (d, x, y)
+        if nearest is None:
+            return False
+        p1[0] = nearest[1]
+        p1[1] = nearest[2]
+        return True
+
+    def draw(self, surface: pg.Surface) -> pg.Rect:
+        """
+        予測線を描画する
+        surface: 描画先のSurface
+        返り値: 描画した範囲のRect(表示していなければNone)
+        """
+        if not self.visible:
+            return None
+        ox, oy = camera.offset
+        for p, sp in zip(self.points, self.__screen_points):
+            sp[0] = p[0] - ox
+            sp[1] = p[1] - oy
+        return pg.draw.lines(surface, __class__.color, False, self.__screen_points, 3)
 
-    def update(self):
-        
-        self.life += 1
-        #自動で消えるまでの時間
-        if self.life > 20:
-            self.kill()
-        self.vel[0] += self.acc[0]
-        self.vel[1] += self.acc[1]
-        
-        self.rect.x += self.vel[0]
-        self.rect.y += self.vel[1]
-        
-    def set_vel(self,vx,vy):
-        self.vel[1] = vy
-        self.vel[0] = vx
-        
 class Enemy(pg.sprite.Sprite):  # エネミークラス
     x = 400
     y = 700
     def __init__(self, center: tuple[int, int]):
-        global dynamic_rect_lst
         super().__init__()
-        self.image = pg.Surface((64, 64))
-        self.image.fill((255, 0, 0))
+        self.image = image_cache.get("enemy", (64, 64), (255, 0, 0))
         self.rect = self.image.get_rect()
-        dynamic_rect_lst.append(self.rect)
         self.rect.center = center
-        self.life = 0
+        registry.register("enemy", self)
 
-    def update(self):
-        global VIEW_POS
-        if self.life % 60 == 0 and 0 <= self.rect.centerx <= WIDTH:
-            self.throw_bomb()
-        self.life += 1
-        
     def throw_bomb(self):
         throw_arg = [0,0]
-        player_pos = list(VIEW_POS)
+        # プレイヤーは常にビュー座標に表示されている
+        player_pos = list(camera.to_world(VIEW_POS))
         enemy_pos = list(self.rect.center)
         throw_arg[0] = (player_pos[0] - enemy_pos[0])/10
         throw_arg[1] = (player_pos[1] - enemy_pos[1])/15
-        Bomb(self.rect.center,tuple(throw_arg),power=2.0)
+        Bomb.spawn(self.rect.center,tuple(throw_arg),power=2.0)
+
+class EnemyScheduler:
+    """
+    画面内の敵だけにタイマーホイールでボムを投げさせるクラス
+    ホイールはENEMY_THROW_INTERVAL個のスロットからなり, 毎フレーム1つのスロットの敵だけが投げる
+    画面外の敵はホイールに入れず(休眠), 毎フレームの処理をしない
+    画面に入った敵は最も空いているスロットに入れ, 投げるタイミングをフレームごとに分散させる
+    """
+    def __init__(self, interval: int = ENEMY_THROW_INTERVAL):
+        """
+        EnemySchedulerクラスの初期化
+        interval: ボムを投げる間隔[フレーム](スロットの数)
+        """
+        self.interval = interval
+        self.frame = 0
+        self.__wheel = [{} for _ in range(interval)]    # スロット -> 敵の辞書(登録順を保つため値はNone)
+        self.__slots = {}   # 起きている敵 -> スロット
+
+    def __len__(self) -> int:
+        return len(self.__slots)
+
+    def wake(self, enemy: Enemy):
+        """
+        敵をホイールに入れる
+        半周先のスロットから順に見て, 入っている敵が最も少ないスロットを選ぶ
+        (画面に入ってから最初に投げるまでの時間を, 平均して従来と同じにする)
+        enemy: 画面に入った敵
+        """
+        wheel = self.__wheel
+        start = self.frame + self.interval // 2
+        slot = min(((start + i) % self.interval for i in range(self.interval)), key=lambda k: len(wheel[k]))
+        wheel[slot][enemy] = None
+        self.__slots[enemy] = slot
+
+    def sleep(self, enemy: Enemy):
+        """
+        敵をホイールから外す
+        enemy: 画面から出た, または倒された敵
+        """
+        del self.__wheel[self.__slots.pop(enemy)][enemy]
+
+    def update(self, visible: list[Enemy]):
+        """
+        画面内の敵に合わせてホイールを更新し, 1フレーム進めて今のスロットの敵にボムを投げさせる
+        処理は画面内の敵の数に比例する
+        visible: 画面内の敵のリスト(再生で同じ結果になるよう, 毎回同じ順序にする)
+        """
+        slots = self.__slots
+        visible_set = set(visible)
+        for e in [e for e in slots if e not in visible_set]:
+            self.sleep(e)
+        for e in visible:
+            if e not in slots:
+                self.wake(e)
+        self.frame += 1
+        for e in self.__wheel[self.frame % self.interval]:
+            e.throw_bomb()
+
+class Chunk():
+    """
+    レベルを画面幅ごとに区切ったチャンクに関するクラス
+    チャンク0がワールド座標のx方向[0, WIDTH)を受け持ち, 左右に向かって番号が増減する
+    チャンクのブロックは変化しないため, ブロックのある区画だけを小さなSurfaceに焼き込んで描画する
+    """
+    block_color = (127, 127, 127)   # ブロックの色
+    tile_size = 200     # 焼き込む区画の大きさ(ワールド座標で区切る)
+
+    def __init__(self, index: int, rect: pg.Rect):
+        """
+        Chunkクラスの初期化
+        index: チャンク番号
+        rect: チャンクの全ブロックを含むrect(ワールド座標)
+        """
+        self.index = index
+        self.rect = rect
+        self.blocks = pg.sprite.Group()
+        self.enemies = pg.sprite.Group()
+        self.enemy_count = 0    # 配置の敵の数(倒されたものを含む)
+        self.enemy_ids = {}     # 敵 -> 配置での番号
+        self.tiles = []     # (区画内のブロックを囲むrect(ワールド座標), Surface(ブロックで埋まっていればNone))のリスト
+        self.__parts = {}   # 区画 -> 区画内に切り取ったブロックのrectのリスト
+
+    def bake(self, rect: pg.Rect):
+        """
+        ブロックを区画ごとに切り分けて覚えておく
+        rect: ブロックのrect(ワールド座標)
+        """
+        size = __class__.tile_size
+        for ty in range(rect.top // size, (rect.bottom - 1) // size + 1):
+            for tx in range(rect.left // size, (rect.right - 1) // size + 1):
+                part = rect.clip((tx * size, ty * size, size, size))
+                self.__parts.setdefault((tx, ty), []).append(part)
+
+    def bake_tiles(self):
+        """
+        区画ごとに, 区画内のブロックを囲むだけの大きさのSurfaceを作って描き込むジェネレータ
+        ブロックは単色のため2色のパレットを持つ8ビットのSurfaceにし, ブロックで埋まった区画はSurfaceを作らず描画時に塗りつぶす
+        1区画描き込むごとにTrueを返す
+        """
+        for parts in self.__parts.values():
+            rect = parts[0].unionall(parts)
+            image = None
+            if rect not in parts:
+                image = pg.Surface(rect.size, depth=8)
+                image.set_palette([(0, 0, 0), __class__.block_color])
+                image.set_colorkey((0, 0, 0))
+                for part in parts:
+                    image.fill(__class__.block_color, part.move(-rect.x, -rect.y))
+            self.tiles.append((rect, image))
+            yield True
+        self.__parts = {}
+
+    def serialize(self) -> tuple[int, ...]:
+        """
+        チャンクを配置から再構築するために, 配置から変わった部分を返す
+        ブロックは変化しないため, 倒された敵だけを返す
+        返り値: 倒された敵の配置での番号のタプル
+        """
+        alive = {self.enemy_ids[e] for e in self.enemies}
+        return tuple(i for i in range(self.enemy_count) if i not in alive)
+
+    def kill(self):
+        """
+        チャンクに属するスプライトを全て削除する
+        """
+        for s in self.blocks.sprites() + self.enemies.sprites():
+            s.kill()
+        self.tiles = []
 
 class Level():
     """
     レベル生成と保持を担うクラス
+    チャンクの配置はLevelGeneratorでシードから決め, スプライトの生成は数フレームに分けて行う
     """
-    def __init__(self):
-        global dynamic_rect_lst
+    def __init__(self, seed: int = None, **params):
+        """
+        Levelクラスの初期化
+        seed: 配置を決める乱数のシード(Noneならrandomモジュールから決める)
+        params: 最初のチャンクを作る前にgeneratorに設定するパラメータ(例: max_hole_width=0)
+        """
         self.blocks = pg.sprite.Group()
-        self.__flcl_height = 100    # 床と天井の高さ
-        self.__ceil_y = -HEIGHT // 2    # 天井の中心y座標
-        # 床
-        self.min_floor_width = 100
-        self.max_floor_width = WIDTH // 2
-        # 天井の生成
-        self.create_ceil((WIDTH // 2, self.__ceil_y))
-        # 床の生成
-        self.blocks.add(Block((WIDTH // 2, HEIGHT), (WIDTH, self.__flcl_height)))
-        dynamic_rect_lst.append(self.blocks.sprites()[-1].rect)
-        self.__left_floor_rct = self.blocks.sprites()[-1].rect
-        self.__right_floor_rct = self.blocks.sprites()[-1].rect
-        
-        # 障害物
-        self.min_obstacle_count = 50
-        self.max_obstacle_count = 100
-        self.min_obstacle_width = 50
-        self.min_obstacle_height = 50
-        self.max_obstacle_width = 100
-        self.max_obstacle_height = 100
-
-        # 穴
-        self.min_hole_width = 0
-        self.max_hole_width = WIDTH // 2
-
-        # 敵
         self.enemies = pg.sprite.Group()
-        self.min_enemy_count = 10
-        self.max_enemy_count = 20
+        # ブロックと敵は動かないため, 生成と退避の時だけ登録を更新する
+        self.block_index = SpatialHash(self.blocks)
+        self.enemy_index = SpatialHash(self.enemies)
+        self.enemy_scheduler = EnemyScheduler()
+        # 配置の生成(穴の幅などのパラメータはgeneratorが持つ)
+        self.generator = LevelGenerator(random.getrandbits(32) if seed is None else seed, WIDTH, HEIGHT)
+        for name, value in params.items():
+            if not hasattr(self.generator, name):
+                raise TypeError(f"LevelGeneratorに{name}というパラメータはありません")
+            setattr(self.generator, name, value)
+        # チャンク
+        self.keep_chunk_distance = 2    # カメラからこの画面数より離れたチャンクは退避する
+        self.__chunks = {}  # 読み込まれているチャンク
+        self.__stored_chunks = {}   # 退避したチャンクの番号 -> (倒された敵の配置での番号のタプル, 眠らせたBoxのリスト)
+        self.__left_chunk_index = 0
+        self.__right_chunk_index = 0
+        self.__center_chunk_index = 0
+        # チャンクの先行生成
+        self.prefetch_distance = WIDTH  # 従来の生成位置よりこの距離だけ手前から生成を始める
+        self.build_sprites_per_frame = 16   # 1フレームに生成するスプライトの数
+        self.__builders = {}    # 方向(-1: 左, 1: 右) -> (生成中のチャンクのジェネレータ, 生成前の端の床のrect)
+        # 天井と床だけの最初のチャンク
+        layout = self.generator.chunk(0, 0)
+        for _ in self.build_chunk(0, layout.block_rects(), layout.enemy_centers()):
+            pass
+        self.__ceil_rct = pg.Rect(layout.ceil)
+        self.__left_floor_rct = self.__right_floor_rct = pg.Rect(layout.floor_rects()[-1])
+
+    @property
+    def ceil_rct(self) -> pg.Rect:
+        """
+        最後に配置した天井のrectのgetter
+        返り値: 天井のrect(ワールド座標)
+        """
+        return self.__ceil_rct
 
     def update(self):
         """
         レベルの更新を行う
         """
-        global WIDTH
-        # 左端の床のx座標が-WIDHT//2より大きくなったら生成
-        if self.__left_floor_rct.left >= -WIDTH // 2:
-            self.create_ceil((self.__left_floor_rct.left - WIDTH // 2, self.__ceil_rct.centery))
+        left = camera.apply(self.__left_floor_rct).left
+        right = camera.apply(self.__right_floor_rct).right
+        # 左端の床の画面上のx座標が-WIDHT//2 - prefetch_distanceより大きくなったら生成を始める
+        if -1 not in self.__builders and left >= -WIDTH // 2 - self.prefetch_distance:
             prev_floor_rct = self.__left_floor_rct
-            total = 0
-            # 生成した床の長さが穴を含めてWIDTHを超えるまで生成
-            while total < WIDTH:
-                offset = random.randint(self.min_hole_width, self.max_hole_width)
-                sizex = random.randint(self.min_floor_width, self.max_floor_width)
-                if total + offset + sizex >= WIDTH:
-                    sizex = WIDTH - total
-                    offset = 0
-                    total += sizex
-                else:
-                    total += offset + sizex
-                self.create_floor((self.__left_floor_rct.left - (offset + sizex // 2), self.__left_floor_rct.centery), (sizex, self.__flcl_height))
-                self.__left_floor_rct = self.blocks.sprites()[-1].rect
-            self.create_obstacles((self.__left_floor_rct.left, prev_floor_rct.left), (self.__ceil_rct.bottom, self.__left_floor_rct.top))
-            self.create_enemies((self.__left_floor_rct.left, prev_floor_rct.left), (self.__ceil_rct.bottom, self.__left_floor_rct.top))
-        # 右端の床のx座標がWIDHT * 3//2より小さくなったら生成
-        elif self.__right_floor_rct.right <= WIDTH * 3 // 2:
-            self.create_ceil((self.__right_floor_rct.right + WIDTH // 2, self.__ceil_rct.centery))
+            self.__builders[-1] = (self.build_chunk(*self.layout_chunk(-1)), prev_floor_rct)
+        # 右端の床の画面上のx座標がWIDHT * 3//2 + prefetch_distanceより小さくなったら生成を始める
+        elif 1 not in self.__builders and right <= WIDTH * 3 // 2 + self.prefetch_distance:
             prev_floor_rct = self.__right_floor_rct
-            total = 0
-            # 生成した床の長さが穴を含めてWIDTHを超えるまで生成
-            while total < WIDTH:
-                offset = random.randint(self.min_hole_width, self.max_hole_width)
-                sizex = random.randint(self.min_floor_width, self.max_floor_width)
-                if total + offset + sizex >= WIDTH:
-                    sizex = WIDTH - total
-                    offset = 0
-                    total += sizex
-                else:
-                    total += offset + sizex
-                self.create_floor((self.__right_floor_rct.right + (offset + sizex // 2), self.__right_floor_rct.centery), (sizex, self.__flcl_height))
-                self.__right_floor_rct = self.blocks.sprites()[-1].rect
-            self.create_obstacles((prev_floor_rct.right, self.__right_floor_rct.right), (self.__ceil_rct.bottom, self.__right_floor_rct.top))
-            self.create_enemies((prev_floor_rct.right, self.__right_floor_rct.right), (self.__ceil_rct.bottom, self.__right_floor_rct.top))
+            self.__builders[1] = (self.build_chunk(*self.layout_chunk(1)), prev_floor_rct)
+        # 生成中のチャンクを進める
+        # 生成前の端の床が従来の生成位置まで近づいた場合は残りを一度に生成する
+        for direction, (_, prev_floor_rct) in list(self.__builders.items()):
+            if direction < 0:
+                urgent = camera.apply(prev_floor_rct).left >= -WIDTH // 2
+            else:
+                urgent = camera.apply(prev_floor_rct).right <= WIDTH * 3 // 2
+            self.step_builder(direction, urgent)
+        self.update_chunks()
+
+    def step_builder(self, direction: int, urgent: bool):
+        """
+        生成中のチャンクのスプライトを1フレーム分生成する
+        direction: 生成中のチャンクの方向
+        urgent: Trueの場合は残りを全て生成する
+        """
+        builder = self.__builders[direction][0]
+        count = 0
+        while urgent or count < self.build_sprites_per_frame:
+            if next(builder, None) is None:
+                del self.__builders[direction]
+                return
+            count += 1
 
-    def create_ceil(self, ceil_center: tuple[int, int]):
+    def layout_chunk(self, direction: int) -> tuple[int, list[tuple[int, int, int, int]], list[tuple[int, int]]]:
         """
-        天井を生成する関数
-        ceil_center: 天井の中心座標
+        次のチャンクの配置をgeneratorから受け取る関数
+        スプライトは生成せず, 端の床と天井の位置のみ更新する
+        direction: 生成する方向(-1: 左, 1: 右)
+        返り値: チャンク番号, ブロックのrectのリスト, 敵の中心座標のリストのタプル
         """
-        global WIDTH, dynamic_rect_lst
-        self.blocks.add(Block(ceil_center, (WIDTH, self.__flcl_height)))
-        self.__ceil_rct = self.blocks.sprites()[-1].rect
-        dynamic_rect_lst.append(self.__ceil_rct)
+        if direction < 0:
+            self.__left_chunk_index -= 1
+            index = self.__left_chunk_index
+        else:
+            self.__right_chunk_index += 1
+            index = self.__right_chunk_index
+        layout = self.generator.chunk(index, direction)
+        floor_rct = pg.Rect(layout.floor_rects()[-1])
+        if direction < 0:
+            self.__left_floor_rct = floor_rct
+        else:
+            self.__right_floor_rct = floor_rct
+        self.__ceil_rct = pg.Rect(layout.ceil)
+        return index, layout.block_rects(), layout.enemy_centers()
 
+    def build_chunk(self, index: int, block_rcts: list, enemy_centers: list[tuple[int, int]], defeated: tuple[int, ...] = ()):
+        """
+        配置からスプライトを1つずつ生成し, 最後にチャンクとしてまとめて追加するジェネレータ
+        スプライトを1つ生成するか, ブロックを1区画焼き込むごとにTrueを返す
+        index: チャンク番号
+        block_rcts: ブロックのrect(またはrectのタプル)のリスト
+        enemy_centers: 敵の中心座標のリスト
+        defeated: 倒されていて生成しない敵のenemy_centersでの番号
+        """
+        block_rcts = [pg.Rect(r) for r in block_rcts]
+        chunk = Chunk(index, block_rcts[0].unionall(block_rcts))
+        blocks = []
+        for r in block_rcts:
+            blocks.append(Block(r.center, r.size))
+            chunk.bake(r)
+            yield True
+        yield from chunk.bake_tiles()
+        enemies = []
+        chunk.enemy_count = len(enemy_centers)
+        for i, c in enumerate(enemy_centers):
+            if i in defeated:
+                continue
+            enemy = Enemy(c)
+            chunk.enemy_ids[enemy] = i
+            enemies.append(enemy)
+            yield True
+        self.add_chunk(chunk, blocks, enemies)
 
-    def create_floor(self, floor_center: tuple[int, int], floor_size: tuple[int, int]):
+    def add_chunk(self, chunk: Chunk, blocks: list[Block], enemies: list[Enemy]):
         """
-        床を生成する関数
-        floor_center: 床の中心座標
-        floor_size: 床のサイズ
+        生成したスプライトをチャンクとしてまとめてレベルに追加する関数
+        chunk: ブロックを焼き込んだチャンク
+        blocks: チャンクのブロックのリスト
+        enemies: チャンクの敵のリスト
         """
-        global WIDTH, dynamic_rect_lst
-        self.blocks.add(Block(floor_center, floor_size))
-        dynamic_rect_lst.append(self.blocks.sprites()[-1].rect)
+        chunk.blocks.add(blocks)
+        chunk.enemies.add(enemies)
+        self.blocks.add(blocks)
+        self.enemies.add(enemies)
+        for b in blocks:
+            self.block_index.add(b)
+        for e in enemies:
+            self.enemy_index.add(e)
+        self.__chunks[chunk.index] = chunk
 
-    def create_obstacles(self, rangex: tuple[int, int], rangey: tuple[int, int]):
+    def draw(self, surface: pg.Surface):
         """
-        障害物を生成する関数
-        rangex: x方向の生成範囲
-        rangey: y方向の範囲
+        読み込まれているチャンクのうち画面内のものを描画する
+        surface: 描画先のSurface
         """
-        for i in range(random.randint(self.min_obstacle_count, self.max_obstacle_count)):
-            self.blocks.add(Block((random.randint(*rangex), random.randint(*rangey)), (random.randint(self.min_obstacle_width, self.max_obstacle_width), random.randint(self.min_obstacle_height, self.max_obstacle_height))))
-            dynamic_rect_lst.append(self.blocks.sprites()[-1].rect)   
+        view = surface.get_rect()
+        for chunk in self.__chunks.values():
+            rct = camera.apply(chunk.rect)
+            if view.colliderect(rct):
+                for r, image in chunk.tiles:
+                    if image is None:
+                        surface.fill(Chunk.block_color, camera.apply(r))
+                    else:
+                        surface.blit(image, camera.apply(r))
 
-    def create_enemies(self, rangex: tuple[int, int], rangey: tuple[int, int]):
+    def visible_enemies(self) -> list[Enemy]:
         """
-        敵を生成する関数
-        rangex: x方向の生成範囲
-        rangey: y方向の範囲
+        中心が画面内にある敵を返す
+        画面に重なりうるチャンクの敵だけを調べる
+        返り値: 敵のリスト(チャンク番号順)
         """
-        for i in range(random.randint(self.min_enemy_count, self.max_enemy_count)):
-            self.enemies.add(Enemy((random.randint(*rangex), random.randint(*rangey))))
+        left = camera.offset[0]
+        first = left // WIDTH
+        enemies = []
+        # 敵の中心はチャンクの右端ちょうどにもなるため, 1つ左のチャンクから調べる
+        for index in range(first - 1, first + 2):
+            chunk = self.__chunks.get(index)
+            if chunk is not None:
+                enemies.extend(e for e in chunk.enemies if 0 <= e.rect.centerx - left <= WIDTH)
+        return enemies
+
+    def update_enemies(self):
+        """
+        画面内の敵にボムを投げさせる
+        """
+        self.enemy_scheduler.update(self.visible_enemies())
+
+    def update_chunks(self):
+        """
+        カメラから離れたチャンクを退避し, 近づいた退避済みのチャンクを再読み込みする
+        カメラのいるチャンクが変わった時のみ処理する
+        """
+        center = (camera.offset[0] + WIDTH // 2) // WIDTH
+        if center == self.__center_chunk_index:
+            return
+        self.__center_chunk_index = center
+        for index in [i for i in self.__chunks if abs(i - center) > self.keep_chunk_distance]:
+            self.evict_chunk(index)
+        for index in range(center - self.keep_chunk_distance, center + self.keep_chunk_distance + 1):
+            if index in self.__stored_chunks:
+                self.load_chunk(index)
+
+    def evict_chunk(self, index: int):
+        """
+        チャンクをデータとして退避し, スプライトを削除する
+        チャンクの範囲のBoxは削除せず, 眠らせて残す
+        index: チャンク番号
+        """
+        chunk = self.__chunks.pop(index)
+        # 退避するブロックの上に積まれたBoxは落とさずに眠らせておく
+        frozen = Box.freeze(index, chunk.blocks, index * WIDTH, (index + 1) * WIDTH)
+        self.__stored_chunks[index] = (chunk.serialize(), frozen)
+        for b in chunk.blocks:
+            self.block_index.remove(b)
+        for e in chunk.enemies:
+            self.enemy_index.remove(e)
+        chunk.kill()
+
+    def load_chunk(self, index: int):
+        """
+        退避したチャンクを配置から再構築する. 配置はgeneratorのキャッシュにあればそこから取り出す
+        index: チャンク番号
+        """
+        # チャンク0は最初のチャンクで, それ以外は0から離れる方向に生成している
+        direction = (index > 0) - (index < 0)
+        layout = self.generator.chunk(index, direction)
+        defeated, frozen = self.__stored_chunks.pop(index)
+        for _ in self.build_chunk(index, layout.block_rects(), layout.enemy_centers(), defeated):
+            pass
+        Box.thaw(index, frozen)
+
+class TextCache:
+    """
+    文字列を描画したSurfaceのキャッシュに関するクラス
+    (フォント, 文字列, 色)をキーとし, 容量を超えたら最も長く使われていないものから捨てる
+    フォントは(名前, サイズ)ごとに1度だけ生成する
+    """
+    def __init__(self, capacity: int = 64):
+        """
+        TextCacheクラスの初期化
+        capacity: 保持するSurfaceの最大数
+        """
+        self.__capacity = capacity
+        self.__fonts = {}
+        self.__surfaces = OrderedDict()
+
+    def font(self, size: int, name: str = None) -> pg.font.Font:
+        """
+        フォントを返す
+        size: フォントサイズ
+        name: フォントファイル名(Noneでデフォルトフォント)
+        返り値: フォント
+        """
+        key = (name, size)
+        if key not in self.__fonts:
+            self.__fonts[key] = pg.font.Font(name, size)
+        return self.__fonts[key]
+
+    def render(self, text: str, size: int, color: tuple[int, int, int], name: str = None) -> pg.Surface:
+        """
+        文字列を描画したSurfaceを返す
+        text: 文字列
+        size: フォントサイズ
+        color: 文字色
+        name: フォントファイル名(Noneでデフォルトフォント)
+        返り値: 文字列を描画したSurface
+        """
+        return self.__get((name, size, text, color), lambda: self.font(size, name).render(text, True, color))
+
+    def render_lines(self, lines: tuple[str, ...], size: int, color: tuple[int, int, int], name: str = None) -> pg.Surface:
+        """
+        複数行の文字列を左揃えで1枚に合成したSurfaceを返す
+        lines: 各行の文字列のタプル
+        size: フォントサイズ
+        color: 文字色
+        name: フォントファイル名(Noneでデフォルトフォント)
+        返り値: 合成したSurface
+        """
+        def compose():
+            font = self.font(size, name)
+            line_surfaces = [font.render(line, True, color) for line in lines]
+            surface = pg.Surface((max(s.get_width() for s in line_surfaces), len(lines) * font.get_height()), pg.SRCALPHA)
+            for i, s in enumerate(line_surfaces):
+                surface.blit(s, s.get_rect(bottom=(i + 1) * font.get_height()))
+            return surface
+        return self.__get((name, size, lines, color), compose)
+
+    def __get(self, key: tuple, create) -> pg.Surface:
+        """
+        キャッシュからSurfaceを取り出し, なければ生成して登録する
+        key: キャッシュのキー
+        create: Surfaceを生成する関数
+        返り値: Surface
+        """
+        surface = self.__surfaces.get(key)
+        if surface is None:
+            surface = create()
+            self.__surfaces[key] = surface
+            if len(self.__surfaces) > self.__capacity:
+                self.__surfaces.popitem(last=False)
+        else:
+            self.__surfaces.move_to_end(key)
+        return surface
+
+# 文字列のSurfaceのキャッシュ
+text_cache = TextCache()
 
 class Score:
     """
@@ -567,166 +2130,445 @@ class Score:
         self.time = 0
         self.player_init_pos_x = 0
         self.final_score = 0
-        self.score_font = pg.font.Font(None, 100)
-        self.game_over_font = pg.font.Font(None, 200)
+        self.score_font_size = 100
+        self.game_over_font_size = 200
     
     def modify(self):
         self.score = self.kill_enemy * 100 + self.progress * 100 + self.time        
     def increase(self, points):
         self.time += points
 
-    def render(self, surface):
+    def render(self, surface) -> pg.Rect:
         self.modify()
-        score_surface = self.score_font.render("Score: " + str(self.score), True, (255, 255, 255))
-        surface.blit(score_surface, (0, 0))
+        score_surface = text_cache.render("Score: " + str(self.score), self.score_font_size, (255, 255, 255))
+        return surface.blit(score_surface, (0, 0))
 
-    def render_final(self,surface):
+    def render_final(self,surface) -> list[pg.Rect]:
         self.modify()
         final_score_surfaces = [
-            self.game_over_font.render(f"GameOver!!", True, (255, 0, 0)),
-            self.game_over_font.render(f"Result: {self.score}", True, (255, 255, 255))
+            text_cache.render(f"GameOver!!", self.game_over_font_size, (255, 0, 0)),
+            text_cache.render(f"Result: {self.score}", self.game_over_font_size, (255, 255, 255))
         ]
+        font_height = text_cache.font(self.game_over_font_size).get_height()
         rcts = [s.get_rect() for s in final_score_surfaces]
-        rcts[0].center = (WIDTH // 2, HEIGHT // 2 - self.game_over_font.get_height() // 2)
-        rcts[1].center = (WIDTH // 2, HEIGHT // 2 + self.game_over_font.get_height() // 2)
+        rcts[0].center = (WIDTH // 2, HEIGHT // 2 - font_height // 2)
+        rcts[1].center = (WIDTH // 2, HEIGHT // 2 + font_height // 2)
         for s, r in zip(final_score_surfaces, rcts):
             surface.blit(s, r)
+        return rcts
+
+# 操作方法の各行
+GUIDE_LINES = (
+    "A: Left",
+    "D: Right",
+    "W: Jump",
+    "LClick: Box",
+    "RClick: Bomb",
+    "Shift: Hyper",
+    "Ctrl: Ballistic"
+)
 
-def render_guide(screen: pg.Surface):
-    font = pg.font.Font(None, 64)
-    guide_surfaces = [
-        font.render("A: Left", True, (255, 255, 255)),
-        font.render("D: Right", True, (255, 255, 255)),
-        font.render("W: Jump", True, (255, 255, 255)),
-        font.render("LClick: Box", True, (255, 255, 255)),
-        font.render("RClick: Bomb", True, (255, 255, 255)),
-        font.render("Shift: Hyper", True, (255, 255, 255)),
-        font.render("Ctrl: Ballistic", True, (255, 255, 255))
-    ]
-    rcts = [s.get_rect() for s in guide_surfaces]
-    for i, r in enumerate(rcts):
-        r.left = 0
-        r.bottom = HEIGHT - (len(rcts) - 1 - i) * font.get_height()
-    for s, r in zip(guide_surfaces, rcts):
-        screen.blit(s, r)
-
-def main():
+def render_guide(screen: pg.Surface) -> list[pg.Rect]:
     """
-    ゲームループ
+    操作方法を画面左下に表示する
+    screen: 描画先のSurface
+    返り値: 描画したrectのリスト
     """
-    global dynamic_rect_lst
-    pg.display.set_caption("ハコツミツミ(仮称)")
-    screen = pg.display.set_mode((WIDTH, HEIGHT))
+    guide_surface = text_cache.render_lines(GUIDE_LINES, 64, (255, 255, 255))
+    return [screen.blit(guide_surface, guide_surface.get_rect(bottomleft=(0, HEIGHT)))]
 
-    bg_img = pg.Surface((WIDTH, HEIGHT))
-    dynamic_rect_lst.append(bg_img.get_rect())
+class DirtyRenderer:
+    """
+    前フレームから変化した領域のみを画面に反映する描画に関するクラス
+    スプライトは毎フレーム全て描画し, pg.display.updateに渡す領域だけを絞る
+    """
+    def __init__(self, screen: pg.Surface, bg_img: pg.Surface, full_ratio: float = 0.5):
+        """
+        DirtyRendererクラスの初期化
+        screen: 画面のSurface
+        bg_img: 背景のSurface
+        full_ratio: 変化した領域の面積が画面のこの割合を超えたら全画面を更新する
+        """
+        self.__screen = screen
+        self.__bg_img = bg_img
+        self.__full_area = WIDTH * HEIGHT * full_ratio
+        self.__prev_rcts = []   # 前フレームで描画したrect
+        self.__scroll_rcts = [] # スクロールで動いたブロックの移動前後のrect
+        self.__offset = camera.offset   # 前フレームのカメラのオフセット
+        self.__is_full = True
 
-    player = Player(VIEW_POS)
-    level = Level()
-    score = Score()
-    score.player_init_pos_x = level.blocks.sprites()[0].rect.centerx
-    
-    # BGM再生
-    pg.mixer.init()
-    pg.mixer.music.load("Audio/GamePlayBGM.mp3")
-    pg.mixer.music.play(-1)
+    def begin(self, level: Level):
+        """
+        描画前に前フレームで描画した領域を背景で塗りつぶす
+        カメラが動いた場合は画面内のブロックの移動前後の領域も対象にする
+        level: 描画するレベル
+        """
+        prev_offset, offset = self.__offset, camera.offset
+        self.__offset = offset
+        self.__scroll_rcts = []
+        if not self.__is_full and offset != prev_offset:
+            view = self.__screen.get_rect()
+            if abs(offset[0] - prev_offset[0]) >= WIDTH or abs(offset[1] - prev_offset[1]) >= HEIGHT:
+                self.__is_full = True
+            else:
+                for b in level.block_index.query(view.move(prev_offset).union(view.move(offset))):
+                    # 背景の同じ位置を切り出して塗るため, 画面内に収める
+                    self.__scroll_rcts.append(b.rect.move(-prev_offset[0], -prev_offset[1]).clip(view))
+                    self.__scroll_rcts.append(b.rect.move(-offset[0], -offset[1]).clip(view))
+        if self.__is_full:
+            self.__screen.blit(self.__bg_img, (0, 0))
+            return
+        for r in self.__prev_rcts + self.__scroll_rcts:
+            self.__screen.blit(self.__bg_img, r, r)
 
-    is_bgm_switched = False
-    tmr = 0
-    clock = pg.time.Clock()
-    while True:
-        for event in pg.event.get():
-            if event.type == pg.QUIT:
-                return
-            if event.type == pg.KEYDOWN and (event.key == pg.K_LSHIFT or event.key == pg.K_RSHIFT):
-                # シフトキーが押されたら
-                player.change_state("hyper", 400)
-        if level.blocks.sprites()[0].rect.bottom < -HEIGHT:
-            score.render_final(screen)
-            if not is_bgm_switched:
-                pg.mixer.Sound("Audio/GameOverSE.mp3").play()
-                pg.mixer.music.stop()
-                pg.mixer.music.load("Audio/GameOverBGM.mp3")
-                pg.mixer.music.play(-1)
-                is_bgm_switched = True
+    def end(self, rcts: list[pg.Rect]):
+        """
+        前フレームとこのフレームで描画した領域を画面に反映する
+        変化した領域が広すぎる場合は全画面を更新する
+        rcts: このフレームで描画したrectのリスト
+        """
+        dirty = self.__prev_rcts + self.__scroll_rcts + rcts
+        self.__prev_rcts = rcts
+        self.__scroll_rcts = []
+        if self.__is_full or sum(r.w * r.h for r in dirty) > self.__full_area:
             pg.display.update()
-            continue
+        else:
+            pg.display.update(dirty)
+        self.__is_full = False
 
-        
-        key_lst = pg.key.get_pressed()
+class PhaseTimer:
+    """
+    1フレーム内の処理ごとの経過時間を計測するクラス
+    enabledがFalseの間は何もしない
+    """
+    def __init__(self, enabled: bool = False):
+        """
+        PhaseTimerクラスの初期化
+        enabled: 計測するかどうか
+        """
+        self.enabled = enabled
+        self.phases = {}    # 処理名 -> 直近のフレームでの経過時間[秒]
+        self.__last = 0.0
+
+    def start(self):
+        """
+        フレームの計測を始める
+        """
+        if self.enabled:
+            self.phases = {}
+            self.__last = time.perf_counter()
+
+    def resume(self):
+        """
+        直前の処理の外で経過した時間(描画の待ち時間など)を数えずに計測を続ける
+        """
+        if self.enabled:
+            self.__last = time.perf_counter()
+
+    def lap(self, name: str):
+        """
+        前回の計測からの経過時間を処理名に加算する
+        name: 処理名
+        """
+        if self.enabled:
+            now = time.perf_counter()
+            self.phases[name] = self.phases.get(name, 0.0) + now - self.__last
+            self.__last = now
+
+class PerfHUD:
+    """
+    処理ごとの時間, フレーム時間のグラフ, オブジェクト数を画面に重ねて表示するクラス
+    表示も記録もしていない間はPhaseTimerを止めておくため, ほとんど負荷がかからない
+    数値とグラフはrefresh_framesフレームごとに1枚のSurfaceに作り直し, 毎フレーム文字列を描画しない
+    """
+    history = 120           # グラフに表示するフレーム数
+    refresh_frames = 15     # 表示する数値を作り直す間隔
+    font_size = 24
+    graph_size = (240, 60)
+    graph_ms = 1000 / 30    # グラフの上端のフレーム時間[ms]
+
+    def __init__(self, timer: PhaseTimer):
+        """
+        PerfHUDクラスの初期化
+        timer: 計測に使うPhaseTimer(もとから有効ならそのまま有効にしておく)
+        """
+        self.timer = timer
+        self.visible = False
+        self.rows = None    # 書き出し用の全フレームの記録(記録していなければNone)
+        self.__keep_timer = timer.enabled
+        self.__frame_ms = deque([0.0] * __class__.history, maxlen=__class__.history)
+        self.__phase_sum = {}
+        self.__samples = 0
+        self.__rendered = 0  # 取り込んだ描画フレーム数
+        self.__panel = pg.Surface(__class__.graph_size, pg.SRCALPHA)  # グラフと数値を合成したSurface
+
+    @property
+    def is_active(self) -> bool:
+        """
+        表示または記録しているかどうか
+        """
+        return self.visible or self.rows is not None
+
+    def toggle(self):
+        """
+        表示を切り替える
+        """
+        self.visible = not self.visible
+        self.timer.enabled = self.__keep_timer or self.is_active
+
+    def record(self):
+        """
+        書き出し用に全フレームの記録を始める
+        """
+        self.rows = []
+        self.timer.enabled = True
+
+    def sample(self, sim_frame: int, updates: int, counts: dict[str, int]):
+        """
+        直近の描画フレームの処理ごとの時間とオブジェクト数を取り込む
+        処理ごとの時間はそのフレームで実際に行った更新(0回以上)と描画の合計
+        sim_frame: それまでの更新回数
+        updates: そのフレームで行った更新の回数
+        counts: 種類ごとのオブジェクト数
+        """
+        phases = self.timer.phases
+        frame_ms = sum(phases.values()) * 1000
+        self.__frame_ms.append(frame_ms)
+        self.__rendered += 1
+        if self.rows is not None:
+            row = {"frame": self.__rendered, "sim_frame": sim_frame, "updates": updates, "frame_ms": frame_ms}
+            row.update((f"{name}_ms", t * 1000) for name, t in phases.items())
+            row.update(counts)
+            self.rows.append(row)
+        if not self.visible:
+            return
+        for name, t in phases.items():
+            self.__phase_sum[name] = self.__phase_sum.get(name, 0.0) + t
+        self.__samples += 1
+        if self.__samples >= __class__.refresh_frames:
+            self.__refresh(counts)
+
+    def __refresh(self, counts: dict[str, int]):
+        """
+        平均した数値とグラフを半透明の背景に合成し直す
+        counts: 種類ごとのオブジェクト数
+        """
+        n = self.__samples
+        recent = list(self.__frame_ms)[-n:]
+        lines = [f"frame {sum(recent) / n:.2f}ms (max {max(recent):.2f}ms)"]
+        lines += [f"{name} {t / n * 1000:.2f}ms" for name, t in self.__phase_sum.items()]
+        lines += [f"{kind} {c}" for kind, c in counts.items()]
+        self.__phase_sum = {}
+        self.__samples = 0
+
+        font = text_cache.font(__class__.font_size)
+        line_surfaces = [font.render(line, True, (255, 255, 0)) for line in lines]
+        w, h = __class__.graph_size
+        panel = pg.Surface((max([w] + [ls.get_width() for ls in line_surfaces]), h + len(lines) * font.get_height()), pg.SRCALPHA)
+        panel.fill((0, 0, 0, 160))
+        # 60fpsの1フレーム分の高さに線を引く
+        y = h - h * (1000 / SIM_FPS) / __class__.graph_ms
+        pg.draw.line(panel, (0, 160, 0), (0, y), (w, y))
+        bar_w = w / __class__.history
+        for i, ms in enumerate(self.__frame_ms):
+            bar_h = min(h, h * ms / __class__.graph_ms)
+            color = (255, 80, 80) if ms > 1000 / SIM_FPS else (255, 255, 255)
+            panel.fill(color, (i * bar_w, h - bar_h, max(1, bar_w), bar_h))
+        for i, ls in enumerate(line_surfaces):
+            panel.blit(ls, (0, h + i * font.get_height()))
+        self.__panel = panel
+
+    def draw(self, surface: pg.Surface, topleft: tuple[int, int]) -> list[pg.Rect]:
+        """
+        グラフと数値を描画する
+        surface: 描画先のSurface
+        topleft: 描画する位置の左上
+        返り値: 描画したrectのリスト
+        """
+        return [surface.blit(self.__panel, topleft)]
+
+    def export(self, path: str):
+        """
+        記録した全フレームの数値を書き出す
+        path: 書き出すファイルのパス(拡張子が.jsonならJSON, それ以外はCSV)
+        """
+        rows = [] if self.rows is None else self.rows
+        if path.endswith(".json"):
+            with open(path, "w") as f:
+                json.dump(rows, f, indent=1)
+            return
+        # 途中で増えた処理名・種類も列にする
+        fields = list(dict.fromkeys(k for row in rows for k in row))
+        with open(path, "w", newline="") as f:
+            writer = csv.DictWriter(f, fields)
+            writer.writeheader()
+            writer.writerows(rows)
+
+class Game:
+    """
+    ゲーム1回分の状態と, 1フレームの更新と描画に関するクラス
+    入力は引数で受け取るため, ウィンドウや実際の入力がなくても動かせる
+    """
+    def __init__(self, screen: pg.Surface, timer: PhaseTimer = None, level_params: dict = None):
+        """
+        Gameクラスの初期化
+        screen: 描画先のSurface
+        timer: 処理ごとの経過時間を計測するPhaseTimer(Noneで計測しない)
+        level_params: Levelのgeneratorに設定するパラメータ(Noneで既定値)
+        """
+        # 前のゲームのスプライトを破棄する
+        for s in registry.world.sprites():
+            s.kill()
+        self.screen = screen
+        self.bg_img = pg.Surface((WIDTH, HEIGHT))
+        self.player = Player(VIEW_POS)
+        camera.follow(self.player.rect)
+        self.level = Level(**(level_params or {}))
+        self.score = Score()
+        self.score.player_init_pos_x = self.player.rect.centerx
+        # 動くスプライトの衝突判定用のSpatialHash
+        self.box_index = SpatialHash(Box.boxes)
+        self.explosion_field = ExplosionField()
+        self.renderer = DirtyRenderer(screen, self.bg_img) if DIRTY_RECT_RENDERING else None
+        self.timer = PhaseTimer() if timer is None else timer
+        self.hud = PerfHUD(self.timer)
+        self.tmr = 0
+        self.frame_updates = 0  # 今の描画フレームで行った更新の回数
+
+    @property
+    def is_game_over(self) -> bool:
+        """
+        ゲームオーバー判定
+        天井が画面上端からHEIGHT以上離れたら(穴に落ちたら)ゲームオーバー
+        返り値: ゲームオーバーならTrue
+        """
+        return camera.apply(self.level.ceil_rct).bottom < -HEIGHT
+
+    def summary(self) -> dict:
+        """
+        入力の記録と再生の結果を比べるための, 現在の状態のまとめ
+        返り値: 更新回数, スコア, 種類ごとの生存数の辞書
+        """
+        self.score.modify()
+        return {"frames": self.tmr, "score": self.score.score, "counts": registry.counts()}
+
+    def perf_counts(self) -> dict[str, int]:
+        """
+        性能の表示・記録に使うオブジェクト数
+        返り値: 種類ごとの生存数に, 起きているBox, 起きている敵, 爆風の候補の組, SpatialHashに登録したBox, 予測線の点の数を加えた辞書
+        """
+        counts = registry.counts()
+        counts["awake"] = len(Box.awake)
+        counts["enemy-awake"] = len(self.level.enemy_scheduler)
+        counts["explode-pairs"] = self.explosion_field.pairs
+        counts["box-hash"] = len(self.box_index)
+        counts["preview"] = len(self.player.preview.points) if self.player.preview.visible else 0
+        return counts
+
+    def begin_frame(self):
+        """
+        描画フレームの始まりに呼び, 処理ごとの時間の計測をやり直す
+        """
+        self.timer.start()
+        self.frame_updates = 0
+
+    def update(self, inputs: InputSnapshot):
+        """
+        1フレーム分の更新を行う
+        inputs: 入力の状態
+        """
+        player, level, score, timer = self.player, self.level, self.score, self.timer
+        box_index = self.box_index
+        timer.resume()
+        self.frame_updates += 1
+
+        # 補間描画のため, 動くものの更新前の位置を覚えておく
+        player.prev_pos = player.rect.topleft
+        for s in Box.awake:
+            s.prev_pos = s.rect.topleft
+        for s in Bomb.bombs:
+            s.prev_pos = s.rect.topleft
+
+        if pg.K_F3 in inputs.pressed:
+            # F3キーで性能の表示を切り替える
+            self.hud.toggle()
+        if pg.K_LSHIFT in inputs.pressed or pg.K_RSHIFT in inputs.pressed:
+            # シフトキーが押されたら
+            player.change_state("hyper", 400)
 
         # 各スプライトの更新
-        player.update(key_lst)
+        player.update(inputs)
         # Box
-        Box.boxes.update()
+        Box.update_all()
         # Bomb
-        Bomb.bombs.update()
+        Bomb.update_all()
         # Explode
         Explode.explodes.update()
-        # predict
-        Throw_predict.predicts.update()
-        # Enemy
-        level.enemies.update()
+        # Enemy(画面内のものだけ)
+        level.update_enemies()
         # Level
         level.update()
+        timer.lap("update")
 
-        # スクロール処理
-        # player以外のrectをplayerの速度に応じて移動
-        # 床はy方向のみ移動
-        for r in dynamic_rect_lst:
-            r.x -= int(player.vel[0])
-            if not player.is_grounded:
-                r.y -= int(player.vel[1])
-                
+        # playerの移動とブロックとの衝突判定
+        # 接地時はx方向のみ移動し, 足元にブロックもBoxもなくなったら落下を始める
+        # スクロールは描画時にカメラのオフセットとして適用する
+        vx, vy = player.vel
+        blocked_x, blocked_y = level.block_index.sweep(player.rect, player.pos, (vx, 0 if player.is_grounded else vy))
+        if blocked_x:
+            player.set_vel(0)
+        if blocked_y:
+            player.set_vel(vy=0)
+        if blocked_y > 0:
+            player.is_grounded = True
+        elif player.is_grounded:
+            below = pg.Rect(player.rect.left, player.rect.bottom, player.rect.width, 1)
+            player.is_grounded = len(level.block_index.candidates(below)) > 0 or len(box_index.candidates(below)) > 0
         
         #毎フレーム落下するとして初期化
-        for i in Box.boxes:
-            i.is_ground = False
-        for i in Bomb.bombs:
-            i.is_ground = False
+        Box.clear_ground(Box.awake)
+        Bomb.clear_ground(Bomb.bombs)
+        timer.lap("move")
             
-        #Boxの接地判定
-        collide_lst_n = pg.sprite.groupcollide(Box.boxes, level.blocks, False,False)
-        for box,collide_lst in collide_lst_n.items():
-            if len(collide_lst) == 0:
-                box.is_ground = False
-            for b in collide_lst:
-                # x方向
-                if  box.rect.right <= b.rect.left + box.vel[0] or box.rect.left >= b.rect.right + box.vel[0]:
-                    if box.vel[0] < 0:
-                        gap = b.rect.right - box.rect.left
-                        box.rect.centerx = box.rect.centerx + gap
-                        box.vel[0] = 0
-                    elif box.vel[0] > 0:
-                        gap = box.rect.right - b.rect.left
-                        box.rect.centerx = box.rect.centerx - gap
-                        
-                        box.vel[0] = 0
-                # y方向
-                else:
-                    if box.vel[1] > 0:
-                        
-                        gap = box.rect.bottom - b.rect.top - 1
-                        box.rect.centery =  box.rect.centery - gap
-                        box.is_ground = True
-                    elif box.vel[1] < 0:
-                        gap = b.rect.bottom - box.rect.top
-                        box.rect.centery = box.rect.centery + gap
-                    box.vel[1] = 0
-        
+        #Boxの移動とブロックとの衝突判定
+        #速度の分の移動の途中で最初に触れたブロックの手前で止める
+        sweep = level.block_index.sweep
+        for box in Box.awake.sprites():
+            vel = box.vel
+            blocked_x, blocked_y = sweep(box.rect, box.pos, (vel[0], vel[1]))
+            if box.rect.top > Box.fall_limit:
+                box.kill()
+                continue
+            if blocked_x:
+                vel[0] = 0
+            if blocked_y:
+                vel[1] = 0
             # Boxの摩擦処理
-            if box.is_ground:
-                box.vel[0] = (0.3 * box.vel[0])
+            if blocked_y > 0:
+                box.is_ground = True
+                vel[0] = Box.friction * vel[0]
         
-        #Bombの接地判定
-        collide_lst = pg.sprite.groupcollide(Bomb.bombs, level.blocks, False,False)
-        for i in collide_lst:
-            i.is_ground = True
+        timer.lap("box-block")
+
+        #Bombの移動とブロックとの衝突判定 ブロックに触れたら止まる
+        for bomb in Bomb.bombs.sprites():
+            vel = bomb.vel
+            if any(sweep(bomb.rect, bomb.pos, (vel[0], vel[1]))):
+                bomb.is_ground = True
+            elif bomb.rect.top > Bomb.fall_limit:
+                bomb.kill()
         
+        timer.lap("bomb-block")
+
         #Box同士の衝突判定
-        collide_lst = pg.sprite.groupcollide(Box.boxes, Box.boxes, False,False)
+        box_index.refresh(Box.awake)
+        collide_lst = box_index.groupcollide(Box.awake, False,False)
     
         for obj,collide_lst_2 in collide_lst.items():
+            if obj.rest_frames == 0:
+                # 動いているBoxが触れた眠っているBoxを起こす
+                for obj2 in collide_lst_2:
+                    obj2.wake()
             if len(collide_lst_2) > 1:
                 for obj2 in collide_lst_2:
                     if not obj is obj2:
@@ -751,74 +2593,49 @@ def main():
                                 obj.vel[0] = 0
         
     
+        timer.lap("box-box")
+
         #BombとBoxのCollide
-        collide_lst = pg.sprite.groupcollide(Bomb.bombs, Box.boxes, False,False)
+        box_index.refresh(Box.awake)
+        collide_lst = box_index.groupcollide(Bomb.bombs, False,False)
         for bomb in collide_lst:
             bomb.set_vel(0,0)
             bomb.is_ground = True
-        #Bombによって召喚されたExplodeとBoxのCollide
-        collide_lst = pg.sprite.groupcollide(Explode.explodes, Box.boxes, False,False)
-        for key,items in collide_lst.items():
-            for item in items:
-                throw_arg = [0,0]
-                item_pos = list(item.rect.center)
-                key_pos = list(key.rect.center)
-                power_border = 0.5
-                throw_arg[0] = -(key_pos[0] - item_pos[0])/power_border + 0.001
-                throw_arg[1] = -(key_pos[1] - item_pos[1])/power_border + 0.001
-                item.vel[0] += throw_arg[0]
-                item.vel[1] += throw_arg[1]
-        
-        #予測線の接地判定
-        collide_lst = pg.sprite.groupcollide(Throw_predict.predicts, level.blocks, True,False)
-        
-        # ブロックとの衝突判定
-        collide_lst = pg.sprite.spritecollide(player, level.blocks, False)
-        if len(collide_lst) == 0:
-            player.is_grounded = False
+        timer.lap("bomb-box")
+        #Bombによって召喚されたExplodeの爆風 Box, Bomb, playerをまとめて吹き飛ばす
+        explodes = Explode.explodes.sprites()
+        if explodes:
+            # 眠っているものが多いBoxはSpatialHashで探し, 毎フレーム動くBomb, playerはrectを直接調べる
+            others = [(Bomb.bombs.sprites(), ExplosionField.box_strength)]
+            if player.state != "hyper":
+                others.append(([player], ExplosionField.player_strength))
+            for item, ix, iy in self.explosion_field.impulses(explodes, [(box_index, ExplosionField.box_strength)], others):
+                if item is player:
+                    player.add_vel(ix, iy)
+                    continue
+                if isinstance(item, Box):
+                    if item.frozen_chunk is not None:
+                        continue
+                    item.wake()
+                item.vel[0] += ix
+                item.vel[1] += iy
+                # 吹き飛ばされたBox, Bombは次のフレームで接地していても止めない
+                item.is_ground = False
         else:
-            for b in collide_lst:
-                # x方向
-                if player.rect.right <= b.rect.left + player.vel[0] or player.rect.left >= b.rect.right + player.vel[0]:
-                    if player.vel[0] < 0:
-                        gap = b.rect.right - player.rect.left
-                        for r in dynamic_rect_lst:
-                            r.x -= gap
-                        player.set_vel(0)
-                    elif player.vel[0] > 0:
-                        gap = player.rect.right - b.rect.left
-                        for r in dynamic_rect_lst:
-                            r.x += gap
-                        player.set_vel(0)
-
-                # y方向
-                else:
-                    if player.vel[1] > 0:
-                        gap = player.rect.bottom - b.rect.top
-                        for r in dynamic_rect_lst:
-                            r.y += gap
-                        player.is_grounded = True
-                    elif player.vel[1] < 0:
-                        gap = b.rect.bottom - player.rect.top
-                        for r in dynamic_rect_lst:
-                            r.y -= gap
-                    player.set_vel(vy=0)
-
-        #ExplodeとPlayerの当たり判定 あたると吹っ飛ぶ
-        collide_lst = pg.sprite.spritecollide(player,Explode.explodes, False)
-        if player.state != "hyper":
-            for explode in collide_lst:
-                throw_arg = [0,0]
-                explode_pos = list(explode.rect.center)
-                player_pos = list(player.rect.center)
-                power_border = 3
-                throw_arg[0] = -(explode_pos[0] - player_pos[0])/power_border + 0.001
-                throw_arg[1] = -(explode_pos[1] - player_pos[1])/power_border + 0.001
-                
-                player.add_vel(throw_arg[0],throw_arg[1])
+            self.explosion_field.pairs = 0
         
+        timer.lap("explode")
+
+        #静止したBoxを眠らせる
+        Box.settle(level.block_index, box_index)
+        timer.lap("box-sleep")
+
+        #予測線の計算とブロックとの当たり判定
+        player.preview.trace(player.rect.center, level.block_index)
+        timer.lap("predict")
+
         #BoxにPlayerが乗るための接地判定
-        collide_lst = pg.sprite.spritecollide(player, Box.boxes, False)
+        collide_lst = box_index.spritecollide(player, False)
         for b in collide_lst:
             # x方向
             if False:
@@ -828,8 +2645,7 @@ def main():
                 if player.vel[1] > 0 and b.rect.centery > player.rect.bottom > b.rect.top:
                     
                     gap = player.rect.bottom - b.rect.top
-                    for r in dynamic_rect_lst:
-                        r.y += gap
+                    player.rect.y -= gap
                     player.is_grounded = True
                     
                     player.set_vel(vy=0)
@@ -842,31 +2658,224 @@ def main():
             else:
                 player.set_vel(0.7 * player.vel[0])
 
+        timer.lap("player-box")
+
         # Enemyの当たり判定
-        score.kill_enemy += len(pg.sprite.spritecollide(player, level.enemies, True))
-        
-        # 各種描画処理
-        screen.blit(bg_img, (0, 0))
-        level.blocks.draw(screen)
-        level.enemies.draw(screen)
-        Box.boxes.draw(screen)
-        Bomb.bombs.draw((screen))
-        Explode.explodes.draw((screen))
-        Throw_predict.predicts.draw((screen))
-        screen.blit(player.image, player.rect)
-        score.render(screen)
-        render_guide(screen)
-        pg.display.update()
-
-        tmr += 1
-        score.progress = int(max(score.progress,abs(score.player_init_pos_x - level.blocks.sprites()[0].rect.centerx)/100))
-        if tmr % 60 == 0:
+        score.kill_enemy += len(level.enemy_index.spritecollide(player, True))
+        timer.lap("player-enemy")
+
+        # カメラをplayerに合わせる
+        camera.follow(player.rect)
+
+        self.tmr += 1
+        score.progress = int(max(score.progress,abs(score.player_init_pos_x - player.rect.centerx)/100))
+        if self.tmr % 60 == 0:
             score.increase(1)
-        clock.tick(60)
 
-if __name__ == "__main__":
+    def draw(self, alpha: float = 1.0):
+        """
+        画面の描画を行う
+        alpha: 前の更新からの経過時間の割合(0.0~1.0). 動くものとカメラは前の更新での位置との間に補間する
+        """
+        screen, level, renderer, player = self.screen, self.level, self.renderer, self.player
+        self.timer.resume()
+        player_rct = camera.lerp(player, alpha)
+        # 描画の間だけカメラを補間したplayerの位置に合わせる
+        camera.follow(player_rct)
+        if renderer is None:
+            screen.blit(self.bg_img, (0, 0))
+        else:
+            renderer.begin(level)
+        level.draw(screen)
+        rcts = camera.draw(level.enemies, screen)
+        rcts += camera.draw(Box.boxes, screen, alpha)
+        rcts += camera.draw(Bomb.bombs, screen, alpha)
+        rcts += camera.draw(Explode.explodes, screen)
+        rct = player.preview.draw(screen)
+        if rct is not None:
+            rcts.append(rct)
+        rcts.append(screen.blit(player.image, camera.apply(player_rct)))
+        rcts.append(self.score.render(screen))
+        if self.hud.visible:
+            rcts += self.hud.draw(screen, rcts[-1].bottomleft)
+        rcts += render_guide(screen)
+        self.timer.lap("draw")
+        if renderer is None:
+            pg.display.update()
+        else:
+            renderer.end(rcts)
+        camera.follow(player.rect)
+        self.timer.lap("display")
+        if self.hud.is_active:
+            self.hud.sample(self.tmr, self.frame_updates, self.perf_counts())
+
+    def draw_final(self):
+        """
+        ゲームオーバー画面の描画を行う
+        """
+        rcts = self.score.render_final(self.screen)
+        if self.renderer is None:
+            pg.display.update()
+        else:
+            self.renderer.end(rcts)
+
+def replay_fast(log: InputLog, slowest: int = 5) -> list[str]:
+    """
+    記録した入力を描画せず, フレームレートの制限なしで再生する
+    更新時間の分布と, 特に遅かったフレームの処理ごとの時間を表示する
+    log: 入力の記録
+    slowest: 処理ごとの時間を表示する遅いフレームの数
+    返り値: 記録と一致しなかった項目の説明のリスト
+    """
+    random.seed(log.seed)
+    timer = PhaseTimer(enabled=True)
+    game = Game(pg.display.set_mode((WIDTH, HEIGHT)), timer)
+    frames = []     # (更新時間, 更新回数, 処理ごとの時間)のリスト
+    for inputs in log.snapshots:
+        if game.is_game_over:
+            break
+        game.begin_frame()
+        game.update(inputs)
+        frames.append((sum(timer.phases.values()), game.tmr, timer.phases))
+    if frames:
+        times = sorted(f[0] for f in frames)
+        stats = ", ".join(f"{k} {times[round(p * (len(times) - 1))] * 1000:.3f}"
+                          for k, p in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99), ("max", 1.0)))
+        print(f"frames: {len(frames)}, update[ms]: {stats}")
+        for t, frame, phases in sorted(frames, key=lambda f: f[0], reverse=True)[:slowest]:
+            top = sorted(phases.items(), key=lambda p: p[1], reverse=True)[:3]
+            print(f"  frame {frame}: {t * 1000:.3f}ms (" + ", ".join(f"{n} {v * 1000:.3f}" for n, v in top) + ")")
+    return log.verify(game)
+
+def report_startup(phases: dict[str, float], total: float) -> bool:
+    """
+    起動時間の内訳を表示する
+    phases: 処理名 -> 経過時間[秒](別スレッドでの処理は名前に*を付ける)
+    total: pygameのimportから最初のフレームの描画までの時間[秒]
+    返り値: 目標時間(STARTUP_TARGET_MS)以内に最初のフレームを描画できたかどうか
+    """
+    print(f"{'phase':>16} {'[ms]':>10}")
+    for name, t in phases.items():
+        print(f"{name:>16} {t * 1000:>10.1f}")
+    ok = total * 1000 <= STARTUP_TARGET_MS
+    print(f"time to first frame: {total * 1000:.1f}ms (target {STARTUP_TARGET_MS}ms, {'ok' if ok else 'over'})")
+    print("* 別スレッドで行い, 最初のフレームを待たせない")
+    return ok
+
+def main(record_path: str = None, replay_log: InputLog = None, perf_path: str = None, startup_only: bool = False) -> bool:
+    """
+    ゲームループ
+    record_path: 入力を記録するファイルのパス(Noneなら記録しない)
+    replay_log: 実際の入力の代わりに再生する入力の記録(Noneなら再生しない)
+    perf_path: 全フレームの処理ごとの時間とオブジェクト数を書き出すファイルのパス(.jsonまたは.csv)
+    startup_only: 最初のフレームを描画したら起動時間の内訳を表示して終了する
+    返り値: startup_onlyの場合は起動時間が目標以内かどうか, それ以外はTrue
+    """
+    startup = PhaseTimer(enabled=True)
+    startup.start()
+    # ウィンドウを開く前に音声を初期化し, ウィンドウとレベルを作る間にゲームオーバーの音声を読み込んでおく
+    pg.mixer.init()
+    startup.lap("mixer init")
+    assets.preload(sounds=(GAME_OVER_SE,), music=(GAME_OVER_BGM,))
     pg.init()
-    main()
-    pg.quit()
-    sys.exit()
+    pg.display.set_caption("ハコツミツミ(仮称)")
+    screen = pg.display.set_mode((WIDTH, HEIGHT))
+    startup.lap("display init")
+    # 記録と再生で同じ展開になるよう, 乱数のシードを決めておく
+    seed = random.randrange(2 ** 32) if replay_log is None else replay_log.seed
+    random.seed(seed)
+    game = Game(screen)
+    if perf_path is not None:
+        game.hud.record()
+    startup.lap("level build")
     
+    # BGM再生
+    assets.play_music(GAMEPLAY_BGM)
+    startup.lap("bgm start")
+
+    is_bgm_switched = False
+    clock = pg.time.Clock()
+    inputs = InputSource()
+    source = inputs if replay_log is None else InputReplay(replay_log.snapshots)
+    log = None if record_path is None else InputLog(seed)
+
+    def end_session():
+        """
+        プレイの終了時に入力の記録と性能の記録を保存し, 再生なら結果を確かめる
+        """
+        if perf_path is not None:
+            game.hud.export(perf_path)
+        if log is not None:
+            log.finish(game)
+            log.save(record_path)
+        if replay_log is not None:
+            errors = replay_log.verify(game)
+            print("再生結果: 一致" if not errors else "再生結果: 不一致\n" + "\n".join(errors))
+
+    step = 1 / SIM_FPS
+    lag = 0.0   # まだ更新に使っていない経過時間[秒]
+    while True:
+        # 描画の上限に合わせて待ち, 前の描画からの経過時間を足す
+        lag += clock.tick(RENDER_FPS) / 1000
+        # イベントキューはここで1回だけ取り出す
+        inputs.pump()
+        if inputs.quit:
+            if not is_bgm_switched:
+                end_session()
+            return True
+        if replay_log is not None and source.is_finished and not game.is_game_over:
+            # ゲームオーバーになる前に記録が終わった
+            end_session()
+            return True
+        if game.is_game_over:
+            game.draw_final()
+            if not is_bgm_switched:
+                end_session()
+                assets.sound(GAME_OVER_SE).play()
+                assets.play_music(GAME_OVER_BGM)
+                is_bgm_switched = True
+            continue
+
+        # 一定間隔の更新を経過時間の分だけ行い, 残りの時間の割合で補間して描画する
+        # 処理が重くて遅れすぎた分は取り戻さずに捨てる
+        lag = min(lag, MAX_CATCH_UP_STEPS * step)
+        game.begin_frame()
+        while lag >= step and not game.is_game_over:
+            snapshot = source.snapshot()
+            if log is not None:
+                log.append(snapshot)
+            game.update(snapshot)
+            lag -= step
+        game.draw(lag / step)
+        if startup is not None:
+            startup.lap("first frame")
+            phases = {"pygame import": PYGAME_IMPORT_TIME, **startup.phases}
+            total = time.perf_counter() - IMPORT_START
+            phases["other"] = total - sum(phases.values())
+            startup = None
+            if startup_only:
+                assets.wait()
+                phases["asset decode*"] = assets.decode_time
+                return report_startup(phases, total)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="ハコツミツミ(仮称)")
+    parser.add_argument("--record", help="プレイの入力を記録するファイル")
+    parser.add_argument("--replay", help="記録した入力を再生するファイル")
+    parser.add_argument("--fast", action="store_true", help="--replayを描画せず, 制限なしの速さで再生して結果を確かめる")
+    parser.add_argument("--perf", help="処理ごとの時間とオブジェクト数を書き出すファイル(.jsonまたは.csv)")
+    parser.add_argument("--startup", action="store_true",
+                        help="最初のフレームを描画したら起動時間の内訳を表示して終了する(目標時間を超えたら終了コード1)")
+    args = parser.parse_args()
+    if args.replay is not None and args.fast:
+        # ウィンドウ・音声なしで再生する
+        os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+        os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+        pg.init()
+        errors = replay_fast(InputLog.load(args.replay))
+        print("再生結果: 一致" if not errors else "再生結果: 不一致\n" + "\n".join(errors))
+        pg.quit()
+        sys.exit(1 if errors else 0)
+    ok = main(args.record, None if args.replay is None else InputLog.load(args.replay), args.perf, args.startup)
+    pg.quit()
+    sys.exit(0 if ok else 1)